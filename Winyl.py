@@ -4,21 +4,98 @@ import os
 import sys
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
-from config import API_TOKEN, TEMP_DIR
+from aiogram.client.telegram import TelegramAPIServer, SimpleFilesPathWrapper, PRODUCTION
+from config import (
+    API_TOKEN, TEMP_DIR, LOCAL_BOT_API_URL, LOCAL_BOT_API_PATH_MAP,
+    COVER_LOOP_ENABLED, SUBSCRIPTION_REFRESH_ENABLED,
+    FSM_DB_PATH, FSM_SESSION_TTL, FSM_WRITE_DELAY, FSM_CACHE_TTL, RUN_MODE, STARTUP_PREBUILD,
+    METRICS_HOST, METRICS_PORT
+)
+from storage import SQLiteStorage
+from workspace import run_janitor
 from handlers import setup_routers
-from db import init_db
+from db import init_db, close_db
+from job_queue import render_queue
 from utils import ensure_temp_dir
-from concurrent.futures import ThreadPoolExecutor
+from subscriptions import subscription_cache
+from cover_loop import prepare_default_loop
+from offload import shutdown_offload
+from metrics import start_metrics_server
+from telegram_client import create_session
+from startup import warm_up, mark_ready, clear_ready
 
-async def main():
+def setup_logging():
     # Настройка логирования
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        format="%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
         stream=sys.stdout
     )
+
+def create_bot() -> Bot:
+    """Создает бота с дефолтными настройками (и локальным Bot API, если задан)"""
+    logger = logging.getLogger(__name__)
+    api = PRODUCTION
+    if LOCAL_BOT_API_URL:
+        logger.info(f"Используется локальный Bot API сервер: {LOCAL_BOT_API_URL}")
+        api = TelegramAPIServer.from_base(LOCAL_BOT_API_URL, is_local=True)
+        if LOCAL_BOT_API_PATH_MAP:
+            server_dir, local_dir = LOCAL_BOT_API_PATH_MAP
+            api = TelegramAPIServer(
+                base=api.base,
+                file=api.file,
+                is_local=True,
+                wrap_local_file=SimpleFilesPathWrapper(server_dir, local_dir)
+            )
+
+    return Bot(
+        token=API_TOKEN,
+        session=create_session(api),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+
+def create_dispatcher(multiprocess: bool = False, **kwargs) -> Dispatcher:
+    """
+    Создает диспетчер с хранилищем FSM в SQLite.
+    При нескольких процессах состояние читается из БД на каждом обновлении.
+    """
+    storage = SQLiteStorage(
+        FSM_DB_PATH,
+        session_ttl=FSM_SESSION_TTL,
+        write_delay=0 if multiprocess else FSM_WRITE_DELAY,
+        cache_ttl=0 if multiprocess else FSM_CACHE_TTL
+    )
+    dp = Dispatcher(storage=storage, **kwargs)
+    
+    # Подключаем роутеры
+    router = setup_routers()
+    dp.include_router(router)
+    return dp
+
+def start_background_tasks(bot: Bot, primary: bool = True) -> list[asyncio.Task]:
+    """Запускает фоновые задачи; общие для всех процессов задачи — только в основном"""
+    tasks = []
+    if primary:
+        # Цикл вращения стандартной обложки готовим в фоне (если его не собрал прогрев)
+        if COVER_LOOP_ENABLED and not STARTUP_PREBUILD:
+            tasks.append(asyncio.create_task(prepare_default_loop()))
+        
+        # Фоновая очистка временных файлов (квота и максимальный возраст)
+        tasks.append(asyncio.create_task(run_janitor()))
+    
+    # Фоновая перепроверка подписок активных пользователей
+    if SUBSCRIPTION_REFRESH_ENABLED:
+        subscription_cache.start_refresher(bot)
+    return tasks
+
+async def stop_background_tasks(tasks: list[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    await subscription_cache.stop_refresher()
+
+async def main():
+    setup_logging()
     logger = logging.getLogger(__name__)
 
     logger.info("=== Запуск бота Winyl ===")
@@ -28,28 +105,29 @@ async def main():
     # Создаем временную директорию
     ensure_temp_dir()
     
+    # Метрики этапов обработки для Prometheus; /ready отвечает 503 до конца прогрева
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    
     # Инициализация БД
     logger.info("Инициализация базы данных...")
     await init_db()
     
     # Создаем бота с дефолтными настройками
     logger.info("Создание экземпляра бота...")
-    bot = Bot(
-        token=API_TOKEN,
-        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-    )
+    bot = create_bot()
     
     # Настраиваем диспетчер
     logger.info("Настройка диспетчера...")
-    executor = ThreadPoolExecutor(max_workers=3)
-    dp = Dispatcher(storage=MemoryStorage(), executor=executor)
+    dp = create_dispatcher()
     
-    # Подключаем роутеры
-    logger.info("Настройка роутеров...")
-    router = setup_routers()
-    dp.include_router(router)
+    # Проверка ffmpeg и подготовка ресурсов — до первого обновления
+    problems = await warm_up()
+    tasks = start_background_tasks(bot)
     
     try:
+        # Long polling не работает при установленном вебхуке
+        await bot.delete_webhook()
+        mark_ready(problems)
         logger.info("=== Бот запущен и готов к работе ===")
         # Увеличиваем таймаут для long polling
         await dp.start_polling(bot, timeout=60)
@@ -60,13 +138,23 @@ async def main():
         raise
     finally:
         logger.info("Завершение работы бота...")
+        clear_ready()
+        await stop_background_tasks(tasks)
+        if metrics_runner:
+            await metrics_runner.cleanup()
         await bot.session.close()
-        executor.shutdown(wait=True)
+        await render_queue.close()
+        await close_db()
+        shutdown_offload()
         logger.info("Ресурсы освобождены")
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if RUN_MODE == "webhook":
+            from webhook import run_webhook
+            run_webhook()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\nБот остановлен пользователем")
         sys.exit(0)
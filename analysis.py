@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from config import ANALYSIS_SAMPLE_RATE, ANALYSIS_CACHE_SIZE, ANALYSIS_TIMEOUT
+from offload import run_io
+from video import run_ffmpeg, build_ffmpeg_cmd
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Длина фрагмента видеокружка (сек)
+CLIP_SECONDS = 60
+
+# Шаг анализа (сек): по нему считаются RMS и прирост энергии
+FRAME_SECONDS = 0.5
+
+# Вес прироста энергии (атаки, смена частей) относительно громкости
+ONSET_WEIGHT = 0.5
+
+# Начало фрагмента сдвигается к самому тихому шагу рядом (граница фразы), сек
+SNAP_SECONDS = 2
+
+# Лучшая точка начала по file_unique_id (None — анализ не дал результата)
+_cache: OrderedDict[str, int | None] = OrderedDict()
+
+# Анализы, идущие в фоне, по file_unique_id (ссылки держат задачи до завершения)
+_tasks: dict[str, asyncio.Task] = {}
+
+
+def _best_start(pcm: bytes, sample_rate: int) -> int | None:
+    """Начало самого громкого и насыщенного 60-секундного участка (блокирующая функция)"""
+    try:
+        import numpy as np
+    except ImportError:
+        logger.warning("numpy не установлен, подбор лучшего фрагмента отключен")
+        return None
+
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+    frame = int(sample_rate * FRAME_SECONDS)
+    frames_count = len(samples) // frame
+    window = int(CLIP_SECONDS / FRAME_SECONDS)
+    if frames_count <= window:
+        return None
+
+    frames = samples[:frames_count * frame].reshape(frames_count, frame)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    # Прирост логарифмической энергии: вступления барабанов, припев после куплета
+    log_energy = np.log10(rms + 1e-6)
+    onset = np.maximum(np.diff(log_energy, prepend=log_energy[0]), 0)
+
+    def normalized(values):
+        span = values.max() - values.min()
+        return (values - values.min()) / span if span > 0 else np.zeros_like(values)
+
+    score = normalized(rms) + ONSET_WEIGHT * normalized(onset)
+    # Сумма по всем окнам из window шагов через накопленную сумму
+    cumulative = np.concatenate(([0.0], np.cumsum(score)))
+    window_scores = cumulative[window:] - cumulative[:-window]
+    start = int(np.argmax(window_scores))
+
+    # Начинаем с паузы перед громким участком, а не с середины фразы
+    snap = int(SNAP_SECONDS / FRAME_SECONDS)
+    low = max(0, start - snap)
+    high = min(len(window_scores) - 1, start + snap)
+    start = low + int(np.argmin(rms[low:high + 1]))
+    return int(start * FRAME_SECONDS)
+
+
+async def find_best_start(source_id: str | None, audio_path: str, duration: float | None = None) -> int | None:
+    """
+    Подбирает начало лучшего 60-секундного фрагмента трека.
+    Трек декодируется одним проходом в моно PCM низкой частоты через pipe ffmpeg.
+    """
+    if source_id and source_id in _cache:
+        _cache.move_to_end(source_id)
+        return _cache[source_id]
+    if duration is not None and duration <= CLIP_SECONDS:
+        return None
+
+    cmd = build_ffmpeg_cmd(
+        "-i", audio_path,
+        "-vn", "-ac", "1", "-ar", str(ANALYSIS_SAMPLE_RATE),
+        "-f", "s16le", "pipe:1"
+    )
+    try:
+        success, pcm = await asyncio.wait_for(
+            run_ffmpeg(cmd, capture_output=True, duration=duration),
+            ANALYSIS_TIMEOUT
+        )
+        start = await run_io(_best_start, pcm, ANALYSIS_SAMPLE_RATE) if success and pcm else None
+    except asyncio.TimeoutError:
+        logger.warning(f"Анализ громкости не уложился в {ANALYSIS_TIMEOUT} сек: {audio_path}")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка анализа громкости {audio_path}: {e}")
+        return None
+
+    logger.info(f"Лучший фрагмент {audio_path}: начало {start} сек")
+    if source_id:
+        _cache[source_id] = start
+        while len(_cache) > ANALYSIS_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return start
+
+
+def start_analysis(source_id: str | None, audio_path: str, duration: float | None = None):
+    """Запускает подбор лучшего фрагмента в фоне, не задерживая ответ пользователю"""
+    if not source_id or source_id in _cache or source_id in _tasks:
+        return
+    if duration is not None and duration <= CLIP_SECONDS:
+        return
+    task = asyncio.create_task(find_best_start(source_id, audio_path, duration))
+    _tasks[source_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(source_id, None))
+
+
+def ready_best_start(source_id: str | None) -> int | None:
+    """Результат анализа, если он уже готов в этом процессе; None — не готов или не найден"""
+    if not source_id:
+        return None
+    return _cache.get(source_id)
@@ -0,0 +1,343 @@
+"""
+Офлайн-бенчмарк конвейера обработки аудио (без Telegram).
+
+Генерирует синтетические входные файлы через ffmpeg (lavfi): MP3 и M4A разной длины,
+со встроенной обложкой (APIC/covr) и без нее, плюс обложки разного размера.
+Замеряет этапы по отдельности и весь конвейер целиком (путь по умолчанию — один проход,
+цикл вращения, стандартная обложка через stdin — и прежняя цепочка с обрезкой и полным рендером):
+p50/p95 времени, процессорное время (включая дочерние процессы ffmpeg) и пиковый RSS этапа.
+
+    python benchmark.py                         # замер, результат в benchmark_results.json
+    python benchmark.py --save-baseline         # сохранить результат как эталон
+    python benchmark.py --fail-on-regression    # код возврата 1 при замедлении относительно эталона
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image
+from offload import shutdown_offload, run_cpu
+from imaging import make_square
+from config import DEFAULT_COVER
+from utils import cut_audio_async, extract_cover, convert_to_square, get_track_metadata, render_video_note
+from video import make_rotating_circle_video_bytes
+from media_probe import probe_file, probe
+import cover_loop
+import square_cache
+
+DEFAULT_OUTPUT = "benchmark_results.json"
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# Длительности синтетических треков (сек) и стороны обложек (px)
+TRACK_LENGTHS = (30, 180)
+QUICK_TRACK_LENGTHS = (30,)
+COVER_SIZES = (512, 1500, 3000)
+
+
+def _ffmpeg(*args: str):
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args],
+        check=True
+    )
+
+
+def make_cover(path: str, size: int):
+    """Обложка с шумом: JPEG сжимается как у настоящей фотографии"""
+    Image.effect_noise((size, size), 48).convert("RGB").save(path, "JPEG", quality=90)
+
+
+def make_track(path: str, length: int, cover_path: str | None = None):
+    """Синусоида с тегами исполнителя/названия и, при cover_path, встроенной обложкой"""
+    source = ["-f", "lavfi", "-i", f"sine=frequency=440:duration={length}"]
+    tags = ["-metadata", "artist=Benchmark", "-metadata", "title=Synthetic"]
+    codec = ["-c:a", "libmp3lame", "-b:a", "192k"] if path.endswith(".mp3") else ["-c:a", "aac", "-b:a", "128k"]
+    if cover_path is None:
+        _ffmpeg(*source, *codec, *tags, path)
+        return
+
+    art = ["-i", cover_path, "-map", "0:a", "-map", "1:v", "-c:v", "copy", "-disposition:v", "attached_pic"]
+    if path.endswith(".mp3"):
+        art += ["-id3v2_version", "3"]
+    _ffmpeg(*source, *art, *codec, *tags, path)
+
+
+def generate_inputs(directory: str, lengths: tuple[int, ...]) -> tuple[list[dict], list[dict]]:
+    covers = []
+    for size in COVER_SIZES:
+        path = os.path.join(directory, f"cover_{size}.jpg")
+        make_cover(path, size)
+        covers.append({"name": f"cover_{size}", "path": path, "size": size})
+
+    art = covers[1]["path"]
+    tracks = []
+    for ext in (".mp3", ".m4a"):
+        for length in lengths:
+            for with_art in (False, True):
+                name = f"{ext[1:]}_{length}s_{'art' if with_art else 'noart'}"
+                path = os.path.join(directory, name + ext)
+                make_track(path, length, art if with_art else None)
+                tracks.append({"name": name, "path": path, "length": length, "art": with_art})
+    return tracks, covers
+
+
+def _reset_peak_rss():
+    # Linux: запись "5" в clear_refs сбрасывает пик RSS процесса (VmHWM)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_kb() -> int | None:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Measurement:
+    """
+    Время, процессорное время (свое и дочерних процессов) и пиковый RSS процесса серии запусков.
+    Пик RSS сбрасывается перед каждым запуском (Linux); у ffmpeg пик за все время — в отчете один раз.
+    """
+
+    def __init__(self):
+        self.wall: list[float] = []
+        self.cpu: list[float] = []
+        self.peak_rss: int | None = None
+
+    @staticmethod
+    def _cpu() -> float:
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+    async def run(self, func):
+        _reset_peak_rss()
+        cpu = self._cpu()
+        started = time.perf_counter()
+        await func()
+        self.wall.append(time.perf_counter() - started)
+        self.cpu.append(self._cpu() - cpu)
+        peak = _peak_rss_kb()
+        if peak is not None:
+            self.peak_rss = max(self.peak_rss or 0, peak)
+
+    @staticmethod
+    def _percentile(values: list[float], q: float) -> float:
+        ordered = sorted(values)
+        index = max(0, min(len(ordered) - 1, round(q * len(ordered) + 0.5) - 1))
+        return ordered[index]
+
+    def summary(self) -> dict:
+        return {
+            "runs": len(self.wall),
+            "p50_ms": round(self._percentile(self.wall, 0.5) * 1000, 2),
+            "p95_ms": round(self._percentile(self.wall, 0.95) * 1000, 2),
+            "cpu_ms": round(sum(self.cpu) / len(self.cpu) * 1000, 2),
+            "peak_rss_kb": self.peak_rss,
+        }
+
+
+def lifetime_rss() -> dict:
+    """Пик RSS за все время бенчмарка (ru_maxrss в Linux — в КБ): свой и самого большого ffmpeg"""
+    return {
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "max_child_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+async def bench(runs: int, render_runs: int, lengths: tuple[int, ...]) -> dict:
+    results = {}
+    directory = tempfile.mkdtemp(prefix="winyl_bench_")
+    # Циклы вращения и квадратные обложки — во временном каталоге, чтобы замер
+    # не зависел от кэшей прошлых запусков и не засорял кэши бота
+    cover_loop.COVER_LOOP_DIR = os.path.join(directory, "loops")
+    square_cache.SQUARE_CACHE_DIR = os.path.join(directory, "squares")
+    try:
+        tracks, covers = generate_inputs(directory, lengths)
+
+        async def measure(name: str, func, count: int):
+            measurement = Measurement()
+            for _ in range(count):
+                await measurement.run(func)
+            results[name] = measurement.summary()
+            print(f"{name:50} p50={results[name]['p50_ms']:>9.1f} мс  p95={results[name]['p95_ms']:>9.1f} мс")
+
+        def scratch_copy(path: str) -> str:
+            # convert_to_square удаляет исходную обложку — работаем с копией
+            copy_path = os.path.join(directory, f"scratch_{time.perf_counter_ns()}_{os.path.basename(path)}")
+            shutil.copyfile(path, copy_path)
+            return copy_path
+
+        # Запуск пула процессов и сборка циклов (стандартной обложки и встроенной в треки)
+        # не должны попасть в замеры: в работе они готовятся при старте и переиспользуются
+        await run_cpu(os.getpid)
+        art_square = await convert_to_square(scratch_copy(covers[1]["path"]))
+        await measure("get_cover_loop/build", lambda: cover_loop.get_cover_loop(art_square), 1)
+        os.remove(art_square)
+        await cover_loop.prepare_default_loop()
+
+        for cover in covers:
+            # Без кэша квадратных обложек: декодирование и масштабирование каждый раз
+            async def decode(cover=cover):
+                output_path = os.path.join(directory, f"square_{cover['name']}.jpg")
+                await run_cpu(make_square, cover["path"], output_path)
+
+            # convert_to_square: после первого запуска обложка берется из кэша
+            async def square(cover=cover):
+                result = await convert_to_square(scratch_copy(cover["path"]))
+                os.remove(result)
+
+            await measure(f"make_square/{cover['name']}", decode, runs)
+            await measure(f"convert_to_square/{cover['name']}", square, runs)
+
+        for track in tracks:
+            path = track["path"]
+
+            async def cut(path=path):
+                os.remove(await cut_audio_async(path, 10))
+
+            async def cover(path=path):
+                result = await extract_cover(path)
+                if result:
+                    os.remove(result)
+
+            async def metadata(path=path):
+                get_track_metadata(path)
+
+            async def media_probe(path=path):
+                probe_file(path)
+
+            async def render(path=path, length=track["length"]):
+                await make_rotating_circle_video_bytes(path, covers[0]["path"], 0, min(60, length))
+
+            async def render_note(path=path, length=track["length"]):
+                video, _, _ = await render_video_note(path, DEFAULT_COVER, 0, min(60, length))
+                if not video:
+                    raise RuntimeError("Рендер не удался")
+
+            async def end_to_end(path=path, length=track["length"]):
+                # Путь по умолчанию: обрезку выполняет ffmpeg при рендере, сборка из цикла вращения
+                info = await probe(None, path)
+                cover_path = await extract_cover(path, info)
+                square_path = await convert_to_square(cover_path) if cover_path else DEFAULT_COVER
+                video, _, _ = await render_video_note(path, square_path, 0, min(60, length))
+                if not video:
+                    raise RuntimeError("Рендер не удался")
+                for leftover in (cover_path, square_path):
+                    if leftover and leftover != DEFAULT_COVER and os.path.exists(leftover):
+                        os.remove(leftover)
+
+            async def end_to_end_legacy(path=path, length=track["length"]):
+                # Прежняя цепочка: отдельная обрезка и полный рендер с кодированием каждого кадра
+                cut_path = await cut_audio_async(path, 0)
+                cover_path = await extract_cover(cut_path) or scratch_copy(covers[1]["path"])
+                square_path = await convert_to_square(cover_path)
+                video = await make_rotating_circle_video_bytes(cut_path, square_path, 0, min(60, length))
+                if not video:
+                    raise RuntimeError("Рендер не удался")
+                for leftover in (cut_path, cover_path, square_path):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+
+            await measure(f"cut_audio_async/{track['name']}", cut, runs)
+            await measure(f"extract_cover/{track['name']}", cover, runs)
+            await measure(f"get_track_metadata/{track['name']}", metadata, runs)
+            await measure(f"media_probe/{track['name']}", media_probe, runs)
+            await measure(f"make_rotating_circle_video_bytes/{track['name']}", render, render_runs)
+            await measure(f"render_video_note/{track['name']}", render_note, render_runs)
+            await measure(f"end_to_end/{track['name']}", end_to_end, render_runs)
+            await measure(f"end_to_end_legacy/{track['name']}", end_to_end_legacy, render_runs)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        shutdown_offload()
+    return results
+
+
+def _ffmpeg_version() -> str:
+    try:
+        output = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout
+        return output.splitlines()[0] if output else ""
+    except OSError:
+        return ""
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Сравнивает p50 с эталоном; возвращает список замедлившихся замеров"""
+    regressions = []
+    for name, current in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if not reference or not reference["p50_ms"]:
+            continue
+        ratio = current["p50_ms"] / reference["p50_ms"]
+        current["baseline_p50_ms"] = reference["p50_ms"]
+        current["ratio"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: {reference['p50_ms']} -> {current['p50_ms']} мс (x{ratio:.2f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк конвейера Winyl")
+    parser.add_argument("--runs", type=int, default=10, help="запусков для быстрых этапов")
+    parser.add_argument("--render-runs", type=int, default=3, help="запусков рендера и всего конвейера")
+    parser.add_argument("--quick", action="store_true", help="только короткие треки")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат как эталон")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление p50 (доля)")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg не найден в PATH")
+
+    results = asyncio.run(bench(args.runs, args.render_runs, QUICK_TRACK_LENGTHS if args.quick else TRACK_LENGTHS))
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "ffmpeg": _ffmpeg_version(),
+        },
+        "process": lifetime_rss(),
+        "results": results,
+    }
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+        if regressions:
+            print("\nЗамедление относительно эталона:")
+            for line in regressions:
+                print(f"  {line}")
+        else:
+            print("\nЗамедлений относительно эталона нет")
+
+    output = args.baseline if args.save_baseline else args.output
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {output}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
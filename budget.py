@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from config import MEMORY_BUDGET_BYTES
+from metrics import gauge
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class ByteBudget:
+    """
+    Асинхронный семафор в байтах: общий предел памяти под загрузки,
+    промежуточные данные и буферы отправки. Ожидающие обслуживаются по очереди.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._used = 0
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _wake(self):
+        # Строго по очереди: большой запрос не обгоняют мелкие
+        while self._waiters:
+            amount, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self._used + amount > self.limit:
+                return
+            self._waiters.popleft()
+            self._used += amount
+            future.set_result(None)
+
+    async def acquire(self, amount: int) -> int:
+        """Занимает amount байт (не больше всего бюджета); возвращает занятый объем"""
+        amount = max(0, min(amount, self.limit))
+        if not self._waiters and self._used + amount <= self.limit:
+            self._used += amount
+            return amount
+
+        logger.info(
+            f"Ожидание памяти: нужно {amount // (1024 * 1024)} МБ, "
+            f"занято {self._used // (1024 * 1024)}/{self.limit // (1024 * 1024)} МБ"
+        )
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((amount, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Память уже выделена — возвращаем
+                self.release(amount)
+            else:
+                self._wake()
+            raise
+        return amount
+
+    def release(self, amount: int):
+        self._used -= amount
+        self._wake()
+
+    @asynccontextmanager
+    async def reserve(self, amount: int):
+        """Удерживает amount байт на время блока"""
+        acquired = await self.acquire(amount)
+        try:
+            yield
+        finally:
+            self.release(acquired)
+
+
+memory_budget = ByteBudget(MEMORY_BUDGET_BYTES)
+
+gauge("winyl_memory_budget_used_bytes", "Занятая часть бюджета памяти", lambda: memory_budget.used)
+gauge("winyl_memory_budget_waiting", "Задачи, ожидающие памяти", lambda: memory_budget.waiting)
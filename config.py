@@ -6,27 +6,244 @@ API_TOKEN = "ВАШ ТОКЕН"
 # ID канала, на который нужно подписаться
 REQUIRED_CHANNEL = "ID CHANNEL" #можете узнать тут https://t.me/GetChatID_IL_BOT
 
+# Режим получения обновлений: "polling" или "webhook"
+RUN_MODE = "polling"
+
+# Публичный адрес, на который Telegram шлет вебхуки (например, "https://bot.example.com")
+WEBHOOK_URL = None
+WEBHOOK_PATH = "/webhook"
+
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = None
+
+# Адрес, который слушают процессы-обработчики вебхуков
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+
+# Число процессов-обработчиков на одном порту (SO_REUSEPORT).
+# При рендере в процессе бота — не больше RENDER_MAX_CONCURRENCY: каждый процесс рендерит хотя бы один кружок
+WEBHOOK_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+
+# Сколько секунд процесс-обработчик завершает работу после SIGTERM, прежде чем его убьют
+WEBHOOK_STOP_TIMEOUT = 30
+
+# Адрес локального сервера telegram-bot-api (None — облачный api.telegram.org)
+# С локальным сервером файлы не скачиваются, а берутся прямо с диска
+LOCAL_BOT_API_URL = None
+
+# Если сервер работает в контейнере: (каталог файлов на сервере, тот же каталог у бота)
+LOCAL_BOT_API_PATH_MAP = None
+
+# Ограничения Bot API на скачивание файлов ботом
+CLOUD_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+LOCAL_DOWNLOAD_LIMIT = 2000 * 1024 * 1024
+
+# Предельное время чтения файла по HTTP с локального сервера, если его каталог не смонтирован (сек)
+LOCAL_DOWNLOAD_TIMEOUT = 300
+
+# Соединения с Bot API: размер пула и сколько секунд держать простаивающее соединение
+TELEGRAM_POOL_SIZE = 32
+TELEGRAM_KEEPALIVE = 60
+
+# Ограничения Telegram на отправку: всего в секунду, в один чат (в секунду и всплеск),
+# в группу — в минуту
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_GROUP_PER_MINUTE = 20
+
+# Повторы запроса после RetryAfter (flood control)
+TELEGRAM_RETRY_ATTEMPTS = 3
+
 # Временная директория
 TEMP_DIR = "temp"
 
+# Где создаются рабочие каталоги задач (например, "/dev/shm/winyl" — в RAM на tmpfs)
+WORK_DIR = TEMP_DIR
+
+# Предельный объем временных файлов в байтах и их максимальный возраст (сек)
+TEMP_QUOTA_BYTES = 2 * 1024 * 1024 * 1024
+TEMP_MAX_AGE = 3 * 3600
+
+# Как часто запускается очистка временных файлов (сек)
+JANITOR_INTERVAL = 600
+
+# Хранилище состояний FSM (рядом с user_data.db)
+FSM_DB_PATH = "fsm_data.db"
+
+# Брошенные сессии FSM удаляются через N секунд без изменений
+FSM_SESSION_TTL = 24 * 3600
+
+# Задержка записи FSM: изменения одного обработчика уходят в БД одной записью
+FSM_WRITE_DELAY = 0.2
+
+# Сколько секунд прочитанное состояние FSM используется из памяти без обращения к БД
+FSM_CACHE_TTL = 5
+
+# Сколько секунд доверяем результату проверки подписки (подписан / не подписан)
+SUBSCRIPTION_POSITIVE_TTL = 600
+SUBSCRIPTION_NEGATIVE_TTL = 30
+
+# Сколько пользователей держим в кэше подписок
+SUBSCRIPTION_CACHE_SIZE = 50000
+
+# Фоновая перепроверка активных пользователей за N секунд до истечения записи
+SUBSCRIPTION_REFRESH_ENABLED = True
+SUBSCRIPTION_REFRESH_AHEAD = 60
+
 # Директория для статических файлов
 ASSETS_DIR = "assets"
 
 # Обложка по умолчанию
 DEFAULT_COVER = os.path.join(ASSETS_DIR, "default_cover.jpg")
 
-# Добавьте проверку обязательных параметров
-if not API_TOKEN:
-    raise ValueError("API_TOKEN не задан! Завершение работы.")
+# Сколько видеокружков рендерится одновременно (libx264 и так многопоточный)
+RENDER_MAX_CONCURRENCY = max(1, (os.cpu_count() or 1) // 2)
+
+# Сколько рендеров одновременно может занимать один пользователь
+RENDER_PER_USER_LIMIT = 1
+
+# Оценка длительности рендера (сек) до появления реальной статистики
+RENDER_DEFAULT_ETA = 40
+
+# Профили кодирования видеокружка, от лучшего качества к самому быстрому:
+# при высокой нагрузке качество уступает скорости.
+# crf или bitrate (например "600k"), fps, сторона кадра, потоки libx264 (0 — авто)
+ENCODING_PROFILES = {
+    "quality": {"preset": "medium", "crf": 23, "fps": 25, "size": 512, "threads": 0},
+    "balanced": {"preset": "veryfast", "crf": 26, "fps": 25, "size": 512, "threads": 2},
+    "fast": {"preset": "ultrafast", "crf": 30, "fps": 20, "size": 384, "threads": 1},
+}
+
+# Профиль без нагрузки
+ENCODING_DEFAULT_PROFILE = "quality"
+
+# Выбирать профиль по нагрузке (False — всегда ENCODING_DEFAULT_PROFILE).
+# Действует только на полный рендер: циклы вращения (COVER_LOOP_ENABLED) всегда собираются
+# в профиле по умолчанию и кэшируются, а сборка из цикла не кодирует видео и от профиля не ускоряется
+ENCODING_ADAPTIVE = True
+
+# Желаемое время кодирования (сек): если последние рендеры медленнее — профиль проще
+ENCODING_TARGET_SECONDS = 30
+
+# Сколько последних рендеров учитывается при выборе профиля
+ENCODING_WINDOW = 10
 
-# Создаем необходимые директории
-os.makedirs(TEMP_DIR, exist_ok=True)
-print(f"Временная директория: {TEMP_DIR} (существует)")
+# ffmpeg останавливается, если результат не растет столько секунд
+FFMPEG_STALL_TIMEOUT = 30
 
-os.makedirs(ASSETS_DIR, exist_ok=True)
-print(f"Директория для ресурсов: {ASSETS_DIR} (существует)")
+# Предельное время работы ffmpeg: BASE + FACTOR * длительность результата (сек);
+# для команд с неизвестной длительностью — DEFAULT
+FFMPEG_DEADLINE_BASE = 60
+FFMPEG_DEADLINE_FACTOR = 4
+FFMPEG_DEFAULT_DEADLINE = 600
 
-# Проверяем наличие обложки по умолчанию
-if not os.path.exists(DEFAULT_COVER):
-    print(f"⚠️ Внимание: Обложка по умолчанию не найдена по пути {DEFAULT_COVER}")
-    print("Пожалуйста, загрузите файл default_cover.jpg в папку assets/")
+# Как часто обновляется сообщение о ходе генерации (сек)
+STATUS_UPDATE_INTERVAL = 3
+
+# Локальный HTTP-сервер метрик (/metrics в формате Prometheus), None — отключен.
+# Процессы-обработчики вебхуков слушают METRICS_PORT + номер процесса
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9090
+
+# Порт метрик обработчика рендера (render_worker.py); при нескольких на одном хосте — разные
+METRICS_WORKER_PORT = None
+
+# Прогрев при запуске: заранее готовить стандартную обложку и ее цикл вращения
+# (готовность объявляется после них)
+STARTUP_PREBUILD = True
+
+# Файл, который создается, когда процесс готов принимать обновления (None — не создавать);
+# то же состояние отдает GET /ready на порту метрик
+READY_FILE = None
+
+# Общий бюджет памяти (байт) под загрузки, рендер и буферы отправки:
+# новые задачи ждут, пока занятый объем не освободится.
+# Бюджет на машину: процессы webhook делят его поровну, процессы render_worker — на RENDER_WORKER_PROCESSES
+MEMORY_BUDGET_BYTES = 640 * 1024 * 1024
+
+# Сколько процессов render_worker запущено на одной машине (делят бюджет памяти и слоты рендера)
+RENDER_WORKER_PROCESSES = 1
+
+# Оценка памяти одного процесса ffmpeg (libx264) и размера готового видео на секунду
+FFMPEG_PROCESS_BYTES = 160 * 1024 * 1024
+VIDEO_BYTES_PER_SECOND = 100 * 1024
+
+# Оценка памяти ffmpeg при сборке из готового цикла: видеодорожка копируется, кодируется только звук
+FFMPEG_MUX_BYTES = 32 * 1024 * 1024
+
+# Писать готовый видеокружок в файл каталога задачи и отправлять его с диска,
+# не держа весь MP4 в памяти
+UPLOAD_FROM_FILE = False
+
+# Потоки для блокирующего ввода-вывода (чтение тегов, файлов, хэши)
+IO_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Процессы для обработки изображений (декодирование и масштабирование обложек)
+CPU_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))
+
+# Где выполняется рендер: "inline" — в процессе бота,
+# "queue" — отдельными процессами render_worker.py через очередь задач
+RENDER_MODE = "inline"
+
+# Очередь задач рендера (SQLite в режиме WAL). Бот и обработчики должны работать на одной машине:
+# WAL не работает на сетевых файловых системах, для нескольких хостов нужен брокер задач
+JOBS_DB_PATH = "jobs.db"
+
+# Аренда задачи обработчиком (сек), продлевается, пока задача выполняется
+JOB_LEASE_SECONDS = 120
+
+# Число попыток до переноса задачи в dead и пауза между попытками (сек, растет с номером попытки)
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 10
+
+# Как часто обработчик ищет задачи, а бот — обновляет статус (сек)
+JOB_POLL_INTERVAL = 1
+
+# Сколько бот ждет завершения задачи из очереди, прежде чем сообщить об ошибке (сек)
+JOB_STATUS_TIMEOUT = 30 * 60
+
+# Сколько результатов разбора загруженных аудиофайлов держим в памяти
+MEDIA_PROBE_CACHE_SIZE = 1000
+
+# Подбор лучшего 60-секундного фрагмента по громкости (нужен numpy):
+# частота декодирования (Гц), сколько результатов держим, предельное время анализа (сек)
+ANALYSIS_ENABLED = True
+ANALYSIS_SAMPLE_RATE = 4000
+ANALYSIS_CACHE_SIZE = 1000
+ANALYSIS_TIMEOUT = 5
+
+# Дисковый кэш готовых видеокружков (на случай устаревшего file_id)
+RESULT_CACHE_DIR = os.path.join("cache", "results")
+
+# Предельный размер дискового кэша в байтах (0 — кэш отключен)
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Кэш скачанных исходников (аудио и обложек) по file_unique_id
+SOURCE_CACHE_DIR = os.path.join("cache", "sources")
+
+# Предельный размер кэша исходников в байтах (0 — кэш отключен)
+SOURCE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Кэш квадратных обложек 512x512 по хэшу исходной обложки и сколько файлов в нем держим
+SQUARE_CACHE_DIR = os.path.join("cache", "covers")
+SQUARE_CACHE_MAX_ENTRIES = 500
+
+# Обрезка, затухание и рендер за один запуск ffmpeg по исходному файлу
+SINGLE_PASS_PIPELINE = True
+
+# ffmpeg пишет готовый MP4 (фрагментированный) в stdout, без временного файла
+FFMPEG_PIPE_OUTPUT = True
+
+# Собирать видео из заранее отрендеренного цикла вращения обложки
+COVER_LOOP_ENABLED = True
+
+# Кэш циклов вращения обложек
+COVER_LOOP_DIR = os.path.join("cache", "loops")
+
+# Сколько циклов храним (стандартная обложка не вытесняется)
+COVER_LOOP_MAX_ENTRIES = 200
+
+# Добавьте проверку обязательных параметров
+if not API_TOKEN:
+    raise ValueError("API_TOKEN не задан! Завершение работы.")
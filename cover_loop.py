@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import logging
+import os
+from config import DEFAULT_COVER, COVER_LOOP_DIR, COVER_LOOP_MAX_ENTRIES
+from result_cache import cover_hash
+from offload import run_io
+from video import render_cover_loop, video_filter
+from encoding import default_profile
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Циклы, которые сейчас рендерятся: хэш обложки -> задача
+_building: dict[str, asyncio.Task] = {}
+
+
+def _loop_key(cover_path: str) -> str:
+    """Ключ цикла: содержимое обложки и параметры видеодорожки профиля по умолчанию"""
+    raw = f"{cover_hash(cover_path)}|{video_filter(default_profile.size)}|{default_profile.describe()}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _loop_path(key: str) -> str:
+    return os.path.join(COVER_LOOP_DIR, f"{key}.mp4")
+
+
+def cached_cover_loop(cover_path: str) -> str | None:
+    """Путь к уже собранному циклу обложки (без рендера) или None"""
+    path = _loop_path(_loop_key(cover_path))
+    return path if os.path.exists(path) else None
+
+
+async def get_cover_loop(cover_path: str) -> str | None:
+    """
+    Возвращает путь к готовому циклу вращения обложки.
+    Если цикла нет — рендерит его (параллельные запросы одной обложки ждут один рендер).
+    Циклы всегда в профиле по умолчанию: смена профиля под нагрузкой не требует нового цикла.
+    """
+    try:
+        key = await run_io(_loop_key, cover_path)
+    except OSError as e:
+        logger.error(f"Не удалось прочитать обложку {cover_path}: {e}")
+        return None
+
+    path = _loop_path(key)
+    if await run_io(_touch, path):
+        return path
+
+    task = _building.get(key)
+    if task is None:
+        task = asyncio.create_task(_build(cover_path, path))
+        _building[key] = task
+        task.add_done_callback(lambda _: _building.pop(key, None))
+
+    return await asyncio.shield(task)
+
+
+async def _build(cover_path: str, path: str) -> str | None:
+    await run_io(os.makedirs, COVER_LOOP_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp.mp4"
+    try:
+        if not await render_cover_loop(cover_path, tmp_path, profile=default_profile):
+            return None
+        await run_io(os.replace, tmp_path, path)
+        logger.info(f"Цикл вращения сохранен: {path}")
+        await run_io(_evict)
+        return path
+    finally:
+        await run_io(_remove_tmp, tmp_path)
+
+
+def _touch(path: str) -> bool:
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _remove_tmp(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _evict():
+    """Удаляет самые давно использованные циклы сверх лимита (кроме стандартного)"""
+    default_paths = {_loop_path(_loop_key(DEFAULT_COVER))} if os.path.exists(DEFAULT_COVER) else set()
+    entries = [
+        (entry.stat().st_mtime, entry.path)
+        for entry in os.scandir(COVER_LOOP_DIR)
+        if entry.is_file() and entry.name.endswith(".mp4") and ".tmp" not in entry.name
+        and entry.path not in default_paths
+    ]
+    entries.sort()
+    while len(entries) > COVER_LOOP_MAX_ENTRIES:
+        _, path = entries.pop(0)
+        try:
+            os.remove(path)
+            logger.info(f"Цикл вращения вытеснен из кэша: {path}")
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
+
+
+async def prepare_default_loop() -> bool:
+    """Заранее рендерит цикл для стандартной обложки; False — цикл не готов"""
+    if not await run_io(os.path.exists, DEFAULT_COVER):
+        return False
+    path = await get_cover_loop(DEFAULT_COVER)
+    if path:
+        logger.info(f"Цикл стандартной обложки готов: {path}")
+    else:
+        logger.warning("Не удалось подготовить цикл стандартной обложки")
+    return path is not None
@@ -1,46 +1,172 @@
 import aiosqlite
+import asyncio
 import datetime
 import logging
 
 DB_PATH = "user_data.db"
 
+# Окно, за которое накапливаются обновления подписок перед записью одной транзакцией
+WRITE_BATCH_DELAY = 0.05
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Долгоживущее соединение, создается в init_db
+_db: aiosqlite.Connection | None = None
+_connect_lock = asyncio.Lock()
+
+# Отложенная запись подписок: user_id -> is_subscribed
+_pending_subscriptions: dict[int, int] = {}
+_pending_event: asyncio.Event | None = None
+_writer_task: asyncio.Task | None = None
+_closing = False
+
+# Запросы держим константами: sqlite3 кэширует скомпилированные выражения по тексту SQL
+SQL_UPSERT_USER = """
+    INSERT INTO users (user_id, username) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET username = excluded.username
+"""
+SQL_UPSERT_SUBSCRIPTION = """
+    INSERT INTO users (user_id, is_subscribed) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET is_subscribed = excluded.is_subscribed
+"""
+SQL_GET_USER = "SELECT * FROM users WHERE user_id = ?"
+SQL_CHECK_ACCESS = "SELECT is_subscribed FROM users WHERE user_id = ?"
+SQL_GET_VIDEO_NOTE = "SELECT file_id FROM video_note_cache WHERE cache_key = ?"
+SQL_SAVE_VIDEO_NOTE = "INSERT OR REPLACE INTO video_note_cache (cache_key, file_id, created_at) VALUES (?, ?, ?)"
+SQL_DELETE_VIDEO_NOTE = "DELETE FROM video_note_cache WHERE cache_key = ?"
+SQL_SAVE_RENDER_STATS = """
+    INSERT INTO render_stats (
+        created_at, chat_id, profile, mode, cache_key, audio_seconds, encode_seconds, output_bytes, queue_waiting
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+async def get_db() -> aiosqlite.Connection:
+    """Возвращает общее соединение с БД (WAL, synchronous=NORMAL)"""
+    global _db
+    if _db is not None:
+        return _db
+
+    async with _connect_lock:
+        if _db is None:
+            db = await aiosqlite.connect(DB_PATH, cached_statements=64)
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")
+            await db.execute("PRAGMA busy_timeout=5000")
+            _db = db
+    return _db
+
 async def init_db():
     """Инициализация базы данных (упрощенная версия)"""
+    global _pending_event, _writer_task, _closing
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Упрощенная таблица пользователей
-            await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                is_subscribed INTEGER DEFAULT 0
-            )
-            """)
-            
-            # Удаляем ненужные таблицы
-            await db.execute("DROP TABLE IF EXISTS promocodes")
-            await db.execute("DROP TABLE IF EXISTS promocode_usages")
-            await db.execute("DROP TABLE IF EXISTS promo_history")
-            
-            await db.commit()
-            logger.info("База данных успешно инициализирована (упрощенная версия)")
+        db = await get_db()
+        # Упрощенная таблица пользователей
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            is_subscribed INTEGER DEFAULT 0
+        )
+        """)
+
+        # Кэш готовых видеокружков: ключ рендера -> file_id в Telegram
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS video_note_cache (
+            cache_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at TEXT
+        )
+        """)
+
+        # Статистика рендеров: профиль кодирования, время и размер результата
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS render_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT,
+            chat_id INTEGER,
+            profile TEXT NOT NULL,
+            mode TEXT,
+            cache_key TEXT,
+            audio_seconds REAL,
+            encode_seconds REAL,
+            output_bytes INTEGER,
+            queue_waiting INTEGER
+        )
+        """)
+        # Таблица из прежних версий: способ рендера (loop/full) и ключ результата
+        async with db.execute("PRAGMA table_info(render_stats)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        for column in ("mode", "cache_key"):
+            if column not in columns:
+                await db.execute(f"ALTER TABLE render_stats ADD COLUMN {column} TEXT")
+
+        # Удаляем ненужные таблицы
+        await db.execute("DROP TABLE IF EXISTS promocodes")
+        await db.execute("DROP TABLE IF EXISTS promocode_usages")
+        await db.execute("DROP TABLE IF EXISTS promo_history")
+
+        await db.commit()
+
+        _closing = False
+        _pending_event = asyncio.Event()
+        _writer_task = asyncio.create_task(_subscription_writer())
+        logger.info("База данных успешно инициализирована (упрощенная версия)")
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {e}")
         raise
 
+async def close_db():
+    """Дописывает отложенные изменения и закрывает соединение"""
+    global _db, _writer_task, _closing
+    if _writer_task:
+        # Просим фоновую запись завершиться после последней пачки
+        _closing = True
+        _pending_event.set()
+        await _writer_task
+        _writer_task = None
+
+    if _db is not None:
+        await _flush_subscriptions()
+        await _db.close()
+        _db = None
+        logger.info("Соединение с БД закрыто")
+
+async def _subscription_writer():
+    """Фоновая запись подписок пачками"""
+    while not _closing:
+        await _pending_event.wait()
+        if not _closing:
+            # Даем накопиться соседним обновлениям
+            await asyncio.sleep(WRITE_BATCH_DELAY)
+        _pending_event.clear()
+        await _flush_subscriptions()
+
+async def _flush_subscriptions():
+    if not _pending_subscriptions:
+        return
+
+    batch = list(_pending_subscriptions.items())
+    _pending_subscriptions.clear()
+    try:
+        db = await get_db()
+        await db.executemany(SQL_UPSERT_SUBSCRIPTION, batch)
+        await db.commit()
+        logger.info(f"Записано обновлений подписки: {len(batch)}")
+    except Exception as e:
+        logger.error(f"Ошибка записи подписок: {e}")
+        # Возвращаем неудачную пачку, не затирая более свежие значения
+        for user_id, value in batch:
+            _pending_subscriptions.setdefault(user_id, value)
+
 async def add_or_update_user(user_id: int, username: str):
     """Добавляет или обновляет пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT OR REPLACE INTO users (user_id, username) VALUES (?, ?)",
-                (user_id, username)
-            )
-            await db.commit()
-            logger.info(f"Обновлен пользователь: {user_id} ({username})")
+        db = await get_db()
+        await db.execute(SQL_UPSERT_USER, (user_id, username))
+        await db.commit()
+        logger.info(f"Обновлен пользователь: {user_id} ({username})")
     except Exception as e:
         logger.error(f"Ошибка обновления пользователя {user_id}: {e}")
 
@@ -48,46 +174,101 @@ async def set_subscription(user_id: int, active: bool):
     """
     Устанавливает статус подписки на канал
     active: True - подписан, False - не подписан
+    Запись отложенная: обновления объединяются в одну транзакцию.
     """
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE users SET is_subscribed = ? WHERE user_id = ?",
-                (1 if active else 0, user_id)
-            )
-            await db.commit()
-            logger.info(f"Обновлена подписка для {user_id}: статус={active}")
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка обновления подписки {user_id}: {e}")
-        return False
+    _pending_subscriptions[user_id] = 1 if active else 0
+    if _pending_event is not None:
+        _pending_event.set()
+    else:
+        # Фоновая запись не запущена — пишем сразу
+        await _flush_subscriptions()
+    logger.info(f"Обновлена подписка для {user_id}: статус={active}")
+    return True
 
 async def get_user(user_id: int):
     """Возвращает данные пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-                return await cursor.fetchone()
+        if user_id in _pending_subscriptions:
+            await _flush_subscriptions()
+        db = await get_db()
+        async with db.execute(SQL_GET_USER, (user_id,)) as cursor:
+            return await cursor.fetchone()
     except Exception as e:
         logger.error(f"Ошибка получения пользователя {user_id}: {e}")
         return None
 
 async def check_access(user_id: int) -> bool:
     """Проверяет доступ пользователя к боту (только подписка на канал)"""
+    # Еще не записанное обновление свежее, чем строка в БД
+    if user_id in _pending_subscriptions:
+        return bool(_pending_subscriptions[user_id])
+
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute("""
-                SELECT is_subscribed 
-                FROM users 
-                WHERE user_id = ?
-            """, (user_id,)) as cursor:
-                row = await cursor.fetchone()
-                if not row:
-                    logger.info(f"Пользователь {user_id} не найден при проверке доступа")
-                    return False
-                
-                is_subscribed = row[0]
-                return bool(is_subscribed)
+        db = await get_db()
+        async with db.execute(SQL_CHECK_ACCESS, (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            if not row:
+                logger.info(f"Пользователь {user_id} не найден при проверке доступа")
+                return False
+
+            is_subscribed = row[0]
+            return bool(is_subscribed)
     except Exception as e:
         logger.error(f"Ошибка проверки доступа для {user_id}: {e}")
-        return False
\ No newline at end of file
+        return False
+
+async def get_cached_video_note(cache_key: str) -> str | None:
+    """Возвращает file_id готового видеокружка по ключу рендера"""
+    try:
+        db = await get_db()
+        async with db.execute(SQL_GET_VIDEO_NOTE, (cache_key,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша видеокружков: {e}")
+        return None
+
+async def save_cached_video_note(cache_key: str, file_id: str):
+    """Запоминает file_id отправленного видеокружка"""
+    try:
+        db = await get_db()
+        await db.execute(
+            SQL_SAVE_VIDEO_NOTE,
+            (cache_key, file_id, datetime.datetime.now().isoformat())
+        )
+        await db.commit()
+    except Exception as e:
+        logger.error(f"Ошибка записи кэша видеокружков: {e}")
+
+async def delete_cached_video_note(cache_key: str):
+    """Удаляет устаревший file_id из кэша"""
+    try:
+        db = await get_db()
+        await db.execute(SQL_DELETE_VIDEO_NOTE, (cache_key,))
+        await db.commit()
+    except Exception as e:
+        logger.error(f"Ошибка очистки кэша видеокружков: {e}")
+
+async def save_render_stats(
+    chat_id: int,
+    profile: str,
+    mode: str,
+    cache_key: str | None,
+    audio_seconds: float,
+    encode_seconds: float,
+    output_bytes: int,
+    queue_waiting: int
+):
+    """
+    Записывает профиль и результат рендера (output_bytes=0 — рендер не удался).
+    mode — "loop" (сборка из цикла вращения) или "full"; cache_key связывает запись с готовым видео.
+    """
+    try:
+        db = await get_db()
+        await db.execute(SQL_SAVE_RENDER_STATS, (
+            datetime.datetime.now().isoformat(), chat_id, profile, mode, cache_key,
+            audio_seconds, encode_seconds, output_bytes, queue_waiting
+        ))
+        await db.commit()
+    except Exception as e:
+        logger.error(f"Ошибка записи статистики рендера: {e}")
@@ -0,0 +1,102 @@
+import logging
+import math
+from collections import deque
+from config import (
+    ENCODING_PROFILES, ENCODING_DEFAULT_PROFILE, ENCODING_ADAPTIVE,
+    ENCODING_TARGET_SECONDS, ENCODING_WINDOW
+)
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class EncodingProfile:
+    """Настройки libx264 для видеокружка"""
+    __slots__ = ("name", "preset", "crf", "bitrate", "fps", "size", "threads")
+
+    def __init__(self, name: str, preset: str, fps: int, size: int, threads: int = 0,
+                 crf: int | None = None, bitrate: str | None = None):
+        self.name = name
+        self.preset = preset
+        self.crf = crf
+        self.bitrate = bitrate
+        self.fps = fps
+        self.size = size
+        self.threads = threads
+
+    @property
+    def rotation_period_frames(self) -> int:
+        # Обложка вращается со скоростью 0.5 рад/с: полный оборот за 4π секунд
+        return round(4 * math.pi * self.fps)
+
+    def video_args(self) -> list[str]:
+        """Аргументы кодека видео"""
+        args = ["-c:v", "libx264", "-preset", self.preset, "-threads", str(self.threads)]
+        if self.bitrate:
+            args += ["-b:v", self.bitrate]
+        else:
+            args += ["-crf", str(self.crf if self.crf is not None else 23)]
+        return args
+
+    def describe(self) -> str:
+        """Параметры, влияющие на картинку (входят в ключи кэша циклов вращения и готовых видео)"""
+        quality = f"b={self.bitrate}" if self.bitrate else f"crf={self.crf}"
+        return f"{self.preset}|{quality}|{self.fps}fps|{self.size}px"
+
+
+PROFILES = {name: EncodingProfile(name, **params) for name, params in ENCODING_PROFILES.items()}
+
+# От лучшего качества к самому быстрому, начиная с профиля по умолчанию
+_LADDER = list(PROFILES)[list(PROFILES).index(ENCODING_DEFAULT_PROFILE):]
+
+
+class ProfileController:
+    """
+    Выбирает профиль полного рендера по нагрузке: очередь рендера и время последних кодирований.
+    Пустая очередь и быстрые рендеры — профиль по умолчанию; есть очередь или
+    рендеры медленнее цели — на ступень проще; очередь не меньше числа слотов
+    или рендеры вдвое медленнее цели — еще на ступень.
+    Сборка из цикла вращения не кодирует видео: ее время учитывается отдельно и на выбор не влияет.
+    """
+
+    def __init__(self, target_seconds: float, window: int):
+        self.target_seconds = target_seconds
+        # Способ рендера ("full" — полное кодирование, "loop" — сборка из цикла) -> последние времена
+        self._times: dict[str, deque[float]] = {
+            "full": deque(maxlen=window),
+            "loop": deque(maxlen=window),
+        }
+        # Задачи, ожидающие во внешней очереди (обработчики render_worker)
+        self.backlog = 0
+
+    def recent_seconds(self, mode: str = "full") -> float:
+        times = self._times[mode]
+        return sum(times) / len(times) if times else 0.0
+
+    def choose(self, waiting: int, capacity: int) -> EncodingProfile:
+        if not ENCODING_ADAPTIVE:
+            return PROFILES[ENCODING_DEFAULT_PROFILE]
+
+        recent = self.recent_seconds()
+        waiting += self.backlog
+        level = 0
+        if waiting > 0 or recent > self.target_seconds:
+            level = 1
+        if waiting >= capacity or recent > 2 * self.target_seconds:
+            level = 2
+
+        profile = PROFILES[_LADDER[min(level, len(_LADDER) - 1)]]
+        if level:
+            logger.info(
+                f"Профиль кодирования {profile.name}: в очереди {waiting}, "
+                f"среднее время рендера {recent:.1f} сек"
+            )
+        return profile
+
+    def record(self, seconds: float, mode: str = "full"):
+        """Учитывает время завершенного рендера способом mode"""
+        self._times[mode].append(seconds)
+
+
+default_profile = PROFILES[ENCODING_DEFAULT_PROFILE]
+encoding_controller = ProfileController(ENCODING_TARGET_SECONDS, ENCODING_WINDOW)
@@ -1,19 +1,31 @@
 import logging
 import asyncio
+import time
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
 from .keyboards import cut_kb, cover_type_kb
-from config import DEFAULT_COVER
+from config import (
+    DEFAULT_COVER, SINGLE_PASS_PIPELINE, TEMP_DIR, RENDER_MODE, JOB_POLL_INTERVAL, ANALYSIS_ENABLED,
+    JOB_STATUS_TIMEOUT
+)
+from job_queue import render_queue, DONE, DEAD
+from workspace import create_workspace, discard_workspace, mark_in_progress
+import media_probe
+from offload import run_io
+from analysis import start_analysis, ready_best_start, CLIP_SECONDS
+from metrics import gauge
 from utils import (
     save_audio, 
     save_cover, 
     extract_cover, 
     send_result, 
     convert_to_square,
-    cut_audio_async
+    cut_audio_async,
+    finish_job,
+    FileTooLargeError
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -27,21 +39,39 @@ class AudioFSM(StatesGroup):
     waiting_for_cover = State()
     waiting_for_custom_cover = State()
 
+# Telegram удаляет не больше 100 сообщений за один вызов deleteMessages
+DELETE_BATCH_SIZE = 100
+
+# Счетчики фоновой очистки сообщений
+cleanup_stats = {"deleted": 0, "failed": 0}
+
+gauge("winyl_cleanup_messages_total", "Фоновое удаление сообщений бота",
+      lambda: dict(cleanup_stats), label="result", kind="counter")
+
+# Ссылки на фоновые задачи очистки, чтобы их не собрал сборщик мусора
+_cleanup_tasks: set[asyncio.Task] = set()
+
 async def delete_previous_messages(bot, chat_id, state):
-    """Удаляет все предыдущие сообщения бота в этом состоянии"""
+    """Удаляет все предыдущие сообщения бота в этом состоянии (в фоне, пачками)"""
     data = await state.get_data()
     message_ids = data.get("message_ids", [])
+    await state.update_data(message_ids=[])
     
-    for msg_id in message_ids:
+    if message_ids:
+        task = asyncio.create_task(_delete_messages(bot, chat_id, message_ids))
+        _cleanup_tasks.add(task)
+        task.add_done_callback(_cleanup_tasks.discard)
+
+async def _delete_messages(bot, chat_id, message_ids):
+    for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[i:i + DELETE_BATCH_SIZE]
         try:
-            await bot.delete_message(chat_id, msg_id)
-        except TelegramBadRequest as e:
-            if "message to delete not found" not in str(e):
-                logger.warning(f"Ошибка удаления сообщения {msg_id}: {e}")
+            # Уже удаленные сообщения Telegram пропускает сам
+            await bot.delete_messages(chat_id, batch)
+            cleanup_stats["deleted"] += len(batch)
         except Exception as e:
-            logger.warning(f"Не удалось удалить сообщение {msg_id}: {e}")
-    
-    await state.update_data(message_ids=[])
+            cleanup_stats["failed"] += len(batch)
+            logger.debug(f"Не удалось удалить сообщения {batch}: {e}")
 
 async def save_and_track_message(message, state):
     """Сохраняет сообщение для последующего удаления"""
@@ -82,14 +112,36 @@ async def handle_audio(message: Message, state: FSMContext):
         processing_msg = await message.answer("⏳ Обработка трека...")
         await save_and_track_message(processing_msg, state)
         
-        mp3_path = await save_audio(message)
+        # Каждая задача работает в своем каталоге, прежний (если был и не рендерится) удаляем
+        data = await state.get_data()
+        await run_io(discard_workspace, data.get("workspace"))
+        workspace = await run_io(create_workspace)
+        await state.update_data(workspace=workspace)
+        
+        mp3_path = await save_audio(message, workspace)
+        source = message.audio or message.document
+        
+        # Файл разбирается один раз: длительность, теги и обложка нужны на следующих шагах
+        try:
+            info = await media_probe.probe(source.file_unique_id, mp3_path, remember=True)
+        except Exception as e:
+            logger.warning(f"Не удалось разобрать аудиофайл {mp3_path}: {e}")
+            info = None
+        
+        # Подсказываем самый громкий фрагмент, чтобы не рендерить вступление или тишину.
+        # Анализ идет в фоне, его результат берется, когда понадобится точка обрезки
+        duration = info.duration if info else None
+        offer_best = ANALYSIS_ENABLED and (duration is None or duration > CLIP_SECONDS)
+        if offer_best:
+            start_analysis(source.file_unique_id, mp3_path, duration)
         
         track_info = "🎵 Ваш трек"
-        if message.audio:
+        if message.audio and (message.audio.performer or message.audio.title):
             artist = message.audio.performer or ""
             title = message.audio.title or ""
-            if artist or title:
-                track_info = f"🎶 {artist} - {title}"
+            track_info = f"🎶 {artist} - {title}"
+        elif info and (info.artist or info.title):
+            track_info = f"🎶 {info.artist} - {info.title}"
         elif message.document:
             # Для документов попробуем получить имя файла
             if message.document.file_name:
@@ -97,20 +149,34 @@ async def handle_audio(message: Message, state: FSMContext):
         
         await state.update_data(
             audio_path=mp3_path,
+            source_id=source.file_unique_id,
             track_info=track_info
         )
         
         msg = await processing_msg.edit_text(
             f"{track_info}\n\nВыберите точку обрезки:",
-            reply_markup=cut_kb()
+            reply_markup=cut_kb(duration, offer_best, ready_best_start(source.file_unique_id))
         )
         await save_and_track_message(msg, state)
         await state.set_state(AudioFSM.waiting_for_cut)
+    except FileTooLargeError as e:
+        logger.warning(f"Слишком большой файл от {message.chat.id}: {e}")
+        await delete_previous_messages(message.bot, message.chat.id, state)
+        await message.answer(f"❌ {e} Попробуйте файл поменьше.")
+        await finish_job(state)
     except Exception as e:
         logger.error(f"Ошибка обработки аудио: {e}")
         await delete_previous_messages(message.bot, message.chat.id, state)
         await message.answer("❌ Ошибка обработки файла. Попробуйте другой файл.")
-        await state.clear()
+        await finish_job(state)
+
+def best_offset(source_id: str | None) -> int:
+    """Начало лучшего фрагмента; пока анализ не готов — начало трека, как без анализа"""
+    start = ready_best_start(source_id)
+    if start is None:
+        logger.info(f"Анализ трека {source_id} не готов, обрезка с начала")
+        return 0
+    return start
 
 @router.callback_query(AudioFSM.waiting_for_cut, F.data.startswith("cut_"))
 async def handle_cut(callback: CallbackQuery, state: FSMContext):
@@ -119,15 +185,34 @@ async def handle_cut(callback: CallbackQuery, state: FSMContext):
         await delete_previous_messages(callback.bot, callback.message.chat.id, state)
         
         data = await state.get_data()
-        start_sec = int(callback.data.split("_")[1])
-        
-        processing_msg = await callback.message.answer("✂️ Обрезаю аудио...")
-        await save_and_track_message(processing_msg, state)
+        best = callback.data == "cut_best"
+        single_pass = SINGLE_PASS_PIPELINE or RENDER_MODE == "queue"
+        if best and single_pass:
+            # Точка обрезки нужна только при рендере — анализу оставляем время до него
+            start_sec = 0
+        elif best:
+            start_sec = best_offset(data.get('source_id'))
+        else:
+            start_sec = int(callback.data.split("_")[1])
         
-        cut_mp3_path = await cut_audio_async(data['audio_path'], start_sec)
+        if single_pass:
+            # Обрезка выполняется при рендере: ffmpeg сам перемотает оригинал
+            processing_msg = await callback.message.answer("🖼️ Извлекаю обложку...")
+            await save_and_track_message(processing_msg, state)
+            
+            audio_path = data['audio_path']
+            start_time = start_sec
+            cover_msg = processing_msg
+        else:
+            processing_msg = await callback.message.answer("✂️ Обрезаю аудио...")
+            await save_and_track_message(processing_msg, state)
+            
+            audio_path = await cut_audio_async(data['audio_path'], start_sec)
+            start_time = 0
+            cover_msg = await processing_msg.edit_text("🖼️ Извлекаю обложку...")
         
-        cover_msg = await processing_msg.edit_text("🖼️ Извлекаю обложку...")
-        cover_path = await extract_cover(cut_mp3_path)
+        info = media_probe.get_cached(data.get('source_id'), audio_path)
+        cover_path = await extract_cover(audio_path, info)
         
         # Обработка случая, когда обложка не найдена
         if not cover_path:
@@ -135,10 +220,11 @@ async def handle_cut(callback: CallbackQuery, state: FSMContext):
             cover_path = None
         
         await state.update_data(
-            audio_path=cut_mp3_path,
+            audio_path=audio_path,
             cover_path=cover_path,
-            start_time=0,
-            cut_sec=start_sec
+            start_time=start_time,
+            cut_sec=start_sec,
+            best_pending=best and single_pass
         )
         
         cover_menu = await cover_msg.edit_text(
@@ -151,7 +237,7 @@ async def handle_cut(callback: CallbackQuery, state: FSMContext):
         logger.error(f"Ошибка в handle_cut: {e}")
         await delete_previous_messages(callback.bot, callback.message.chat.id, state)
         await callback.message.answer("❌ Ошибка обработки. Пожалуйста, попробуйте ещё раз.")
-        await state.clear()
+        await finish_job(state)
 
 @router.callback_query(AudioFSM.waiting_for_custom_cover, F.data == "back_to_cover_menu")
 async def back_to_cover_menu(callback: CallbackQuery, state: FSMContext):
@@ -216,10 +302,13 @@ async def handle_photo_cover(message: Message, state: FSMContext):
         processing_msg = await message.answer("⏳ Загружаю обложку...")
         await save_and_track_message(processing_msg, state)
         
-        cover_path = await save_cover(message)
-        square_cover = await convert_to_square(cover_path)
+        data = await state.get_data()
+        cover_path = await save_cover(message, data.get("workspace") or TEMP_DIR)
+        if RENDER_MODE != "queue":
+            # В режиме очереди обложку готовит обработчик рендера
+            cover_path = await convert_to_square(cover_path)
         
-        await state.update_data(cover_path=square_cover)
+        await state.update_data(cover_path=cover_path)
         await start_video_processing(message, state)
     except Exception as e:
         logger.error(f"Ошибка обработки обложки: {e}")
@@ -228,6 +317,7 @@ async def handle_photo_cover(message: Message, state: FSMContext):
         await save_and_track_message(error_msg, state)
 
 async def start_video_processing(message: Message, state: FSMContext):
+    workspace = None
     try:
         data = await state.get_data()
         track_info = data.get('track_info', 'Ваш трек')
@@ -235,12 +325,88 @@ async def start_video_processing(message: Message, state: FSMContext):
         processing_msg = await message.answer(
             f"⏳ Генерирую видеокружок для:\n{track_info}\n\nЭто займет 20-60 секунд..."
         )
-        await save_and_track_message(processing_msg, state)
         
-        await send_result(message, state)
+        if data.get("best_pending"):
+            start = best_offset(data.get("source_id"))
+            await state.update_data(start_time=start, cut_sec=start, best_pending=False)
+        
+        if RENDER_MODE == "queue":
+            await enqueue_render(message, state, processing_msg)
+            return
+        
+        await save_and_track_message(processing_msg, state)
+        # Пока идет рендер, пользователь может загрузить новый трек — удаляем именно этот каталог
+        workspace = data.get("workspace")
+        await send_result(message, state, processing_msg)
     except Exception as e:
         logger.error(f"Ошибка генерации видео: {e}")
         await message.answer("❌ Ошибка генерации видео. Попробуйте другой трек.")
     finally:
         await delete_previous_messages(message.bot, message.chat.id, state)
-        await state.clear()
\ No newline at end of file
+        await finish_job(state, workspace)
+
+# Ссылки на задачи, передающие пользователю статус рендера из очереди
+_relay_tasks: set[asyncio.Task] = set()
+
+async def enqueue_render(message: Message, state: FSMContext, status_msg: Message):
+    """Передает задачу обработчикам рендера; каталог задачи теперь принадлежит им"""
+    data = await state.get_data()
+    # Задача может ждать в очереди — каталог отмечается до передачи обработчикам
+    await run_io(mark_in_progress, data.get("workspace"))
+    job_id = await render_queue.enqueue({
+        "chat_id": message.chat.id,
+        "audio_path": data.get("audio_path"),
+        "cover_path": data.get("cover_path"),
+        "start_time": data.get("start_time", 0),
+        "cut_sec": data.get("cut_sec", 0),
+        "source_id": data.get("source_id"),
+        "track_info": data.get("track_info", "Ваш трек"),
+        "workspace": data.get("workspace"),
+    })
+    await state.update_data(workspace=None)
+    
+    task = asyncio.create_task(relay_job_status(status_msg, job_id))
+    _relay_tasks.add(task)
+    task.add_done_callback(_relay_tasks.discard)
+
+async def relay_job_status(status_msg: Message, job_id: int):
+    """Переносит статус задачи из очереди в сообщение пользователя (не дольше JOB_STATUS_TIMEOUT)"""
+    last_progress = None
+    deadline = time.monotonic() + JOB_STATUS_TIMEOUT
+    while True:
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        try:
+            row = None if time.monotonic() > deadline else await render_queue.get(job_id)
+            if row is None:
+                # Задача зависла или пропала из очереди
+                logger.warning(f"Статус задачи {job_id} больше не отслеживается")
+                try:
+                    await status_msg.edit_text(
+                        "❌ Не удалось сгенерировать видеокружок. Пожалуйста, попробуйте ещё раз."
+                    )
+                except Exception as e:
+                    logger.debug(f"Не удалось обновить статус задачи {job_id}: {e}")
+                return
+            status, progress = row
+            if status == DONE:
+                try:
+                    await status_msg.delete()
+                except TelegramBadRequest:
+                    pass
+                return
+            if status == DEAD:
+                # Ошибка во входных данных приходит готовым текстом, остальные — общим сообщением
+                text = progress if progress and progress.startswith("❌") else \
+                    "❌ Не удалось сгенерировать видеокружок. Пожалуйста, попробуйте ещё раз."
+                try:
+                    await status_msg.edit_text(text)
+                except Exception as e:
+                    logger.debug(f"Не удалось обновить статус задачи {job_id}: {e}")
+                return
+            if progress and progress != last_progress:
+                last_progress = progress
+                await status_msg.edit_text(progress)
+        except TelegramBadRequest:
+            pass
+        except Exception as e:
+            logger.warning(f"Ошибка передачи статуса задачи {job_id}: {e}")
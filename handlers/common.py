@@ -3,8 +3,8 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from handlers.keyboards import main_menu_kb, back_kb
-from db import get_user, set_subscription, check_access
-from utils import is_user_subscribed
+from subscriptions import subscription_cache
+from utils import finish_job
 import logging
 
 router = Router()
@@ -22,8 +22,7 @@ async def check_subscription_and_send_welcome(message: Message):
     """Проверяет подписку и отправляет приветственное сообщение"""
     try:
         # Проверяем подписку на канал
-        is_sub = await is_user_subscribed(message.bot, message.from_user.id, CHANNEL_ID)
-        await set_subscription(message.from_user.id, is_sub)
+        is_sub = await subscription_cache.is_subscribed(message.bot, message.from_user.id, CHANNEL_ID)
         
         if not is_sub:
             await message.answer(
@@ -56,7 +55,7 @@ async def send_welcome(message: Message):
 
 async def show_main_menu(message_or_callback, state: FSMContext):
     """Показывает главное меню с очисткой состояния"""
-    await state.clear()
+    await finish_job(state)
     try:
         if isinstance(message_or_callback, Message):
             await message_or_callback.answer("Главное меню:", reply_markup=main_menu_kb())
@@ -70,8 +69,7 @@ async def show_main_menu(message_or_callback, state: FSMContext):
 
 @router.callback_query(F.data == "start")
 async def main_menu_start(callback: CallbackQuery, state: FSMContext):
-    is_subscribed = await is_user_subscribed(callback.bot, callback.from_user.id, CHANNEL_ID)
-    await set_subscription(callback.from_user.id, is_subscribed)
+    is_subscribed = await subscription_cache.is_subscribed(callback.bot, callback.from_user.id, CHANNEL_ID)
     
     if not is_subscribed:
         await callback.message.answer("❌ Для использования бота необходимо подписаться на канал @swr24.")
@@ -92,7 +90,7 @@ async def back_to_menu(callback: CallbackQuery, state: FSMContext):
 
 @router.message(F.text == "🎵 Создать кружок")
 async def create_circle_handler(message: Message, state: FSMContext):
-    if not await check_access(message.from_user.id):
+    if not await subscription_cache.has_access(message.from_user.id):
         await message.answer("❌ Для использования бота необходимо подписаться на канал @swr24.")
         return
     
@@ -12,17 +12,28 @@ def main_menu_kb():
     )
     return builder.as_markup()
 
-def cut_kb():
+# Точки обрезки (сек), по три кнопки в ряду
+CUT_OFFSETS = (0, 30, 60, 90, 120)
+
+def cut_kb(duration: float | None = None, offer_best: bool = False, best_start: int | None = None):
+    """
+    Кнопки точек обрезки; для короткого трека — только те, что раньше его конца.
+    offer_best — добавить кнопку самого громкого фрагмента (его начало подбирается в фоне),
+    best_start — это начало, если анализ уже готов.
+    """
     builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="00:00", callback_data="cut_0"),
-        InlineKeyboardButton(text="00:30", callback_data="cut_30"),
-        InlineKeyboardButton(text="01:00", callback_data="cut_60"),
-    )
-    builder.row(
-        InlineKeyboardButton(text="01:30", callback_data="cut_90"),
-        InlineKeyboardButton(text="02:00", callback_data="cut_120"),
-    )
+    if offer_best:
+        text = "🔥 Лучшие 60 сек"
+        if best_start is not None:
+            text += f" ({best_start // 60:02d}:{best_start % 60:02d})"
+        builder.row(InlineKeyboardButton(text=text, callback_data="cut_best"))
+    offsets = [sec for sec in CUT_OFFSETS if duration is None or sec == 0 or sec < duration]
+    buttons = [
+        InlineKeyboardButton(text=f"{sec // 60:02d}:{sec % 60:02d}", callback_data=f"cut_{sec}")
+        for sec in offsets
+    ]
+    for i in range(0, len(buttons), 3):
+        builder.row(*buttons[i:i + 3])
     builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_menu"))
     return builder.as_markup()
 
@@ -0,0 +1,21 @@
+# Функции этого модуля выполняются в пуле процессов (offload.run_cpu). Пул запускается
+# через spawn: каждый рабочий процесс заново импортирует главный модуль, поэтому пул
+# поднимается один раз при прогреве. PIL загружается при первом вызове — в основном процессе он не нужен
+
+
+def make_square(image_path: str, output_path: str, size: int = 512, quality: int = 90) -> bool:
+    """
+    Сохраняет обложку size x size в JPEG: масштабирует с сохранением пропорций и обрезает
+    лишнее по центру. False — изображение уже подходит и не менялось.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(image_path) as img:
+        if img.size == (size, size) and img.mode == "RGB":
+            return False
+        # Большой JPEG декодируется сразу в уменьшенном масштабе (1/2–1/8, в DCT), но не меньше size
+        if img.format == "JPEG":
+            img.draft("RGB", (size, size))
+        img = ImageOps.fit(img.convert("RGB"), (size, size), Image.LANCZOS)
+        img.save(output_path, "JPEG", quality=quality)
+    return True
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import logging
+import time
+import aiosqlite
+from config import JOBS_DB_PATH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Статусы задач
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+
+class LeaseLostError(RuntimeError):
+    """Аренда задачи истекла, и ее забрал другой обработчик"""
+
+
+class JobQueue:
+    """
+    Надежная очередь задач рендера в SQLite (переживает перезапуск).
+    Обработчик берет задачу в аренду (lease) и продлевает ее, пока работает;
+    задачи с истекшей арендой снова выдаются, после max_attempts попыток — в dead.
+    Задача, результат которой уже отправлен (delivered_at), повторно не выдается.
+    """
+
+    def __init__(self, path: str, lease_seconds: float, max_attempts: int, retry_delay: float):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._db: aiosqlite.Connection | None = None
+        self._lock = asyncio.Lock()
+
+    async def _get_db(self) -> aiosqlite.Connection:
+        if self._db is None:
+            # Транзакции открываем явно (BEGIN IMMEDIATE), поэтому автокоммит
+            db = await aiosqlite.connect(self.path, isolation_level=None)
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")
+            await db.execute("PRAGMA busy_timeout=10000")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS render_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_until REAL,
+                progress TEXT,
+                error TEXT,
+                delivered_at REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """)
+            # Очередь из прежних версий: отметка отправки результата
+            async with db.execute("PRAGMA table_info(render_jobs)") as cursor:
+                columns = {row[1] for row in await cursor.fetchall()}
+            if "delivered_at" not in columns:
+                await db.execute("ALTER TABLE render_jobs ADD COLUMN delivered_at REAL")
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS render_jobs_pending ON render_jobs (status, available_at)"
+            )
+            self._db = db
+        return self._db
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def enqueue(self, payload: dict) -> int:
+        """Ставит задачу в очередь и возвращает ее id"""
+        async with self._lock:
+            db = await self._get_db()
+            now = time.time()
+            cursor = await db.execute(
+                "INSERT INTO render_jobs (payload, status, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (json.dumps(payload, ensure_ascii=False), QUEUED, now, now, now)
+            )
+            logger.info(f"Задача рендера {cursor.lastrowid} поставлена в очередь")
+            return cursor.lastrowid
+
+    async def claim(self, owner: str) -> tuple[int, dict, int] | None:
+        """Берет в аренду следующую задачу: (id, payload, номер попытки)"""
+        async with self._lock:
+            db = await self._get_db()
+            now = time.time()
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                # Обработчик исчерпал попытки и не дошел до fail (например, убит по OOM) — в dead
+                cursor = await db.execute(
+                    "UPDATE render_jobs SET status = ?, lease_owner = NULL, lease_until = NULL, "
+                    "error = ?, updated_at = ? WHERE status = ? AND lease_until < ? AND attempts >= ? "
+                    "AND delivered_at IS NULL",
+                    (DEAD, "аренда истекла на последней попытке", now, RUNNING, now, self.max_attempts)
+                )
+                if cursor.rowcount:
+                    logger.error(f"Задач рендера перенесено в dead по истекшей аренде: {cursor.rowcount}")
+                # Результат отправлен, но обработчик не успел отметить выполнение — повтор не нужен
+                await db.execute(
+                    "UPDATE render_jobs SET status = ?, lease_owner = NULL, lease_until = NULL, updated_at = ? "
+                    "WHERE status = ? AND lease_until < ? AND delivered_at IS NOT NULL",
+                    (DONE, now, RUNNING, now)
+                )
+
+                async with db.execute(
+                    "SELECT id, payload, attempts FROM render_jobs "
+                    "WHERE (status = ? AND available_at <= ?) "
+                    "OR (status = ? AND lease_until < ? AND attempts < ?) "
+                    "ORDER BY id LIMIT 1",
+                    (QUEUED, now, RUNNING, now, self.max_attempts)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                if row is None:
+                    await db.execute("COMMIT")
+                    return None
+
+                job_id, payload, attempts = row
+                await db.execute(
+                    "UPDATE render_jobs SET status = ?, attempts = ?, lease_owner = ?, lease_until = ?, "
+                    "updated_at = ? WHERE id = ?",
+                    (RUNNING, attempts + 1, owner, now + self.lease_seconds, now, job_id)
+                )
+                await db.execute("COMMIT")
+            except Exception:
+                await db.execute("ROLLBACK")
+                raise
+
+        return job_id, json.loads(payload), attempts + 1
+
+    async def heartbeat(self, job_id: int, owner: str) -> bool:
+        """Продлевает аренду; False — задачу уже забрал другой обработчик"""
+        async with self._lock:
+            db = await self._get_db()
+            now = time.time()
+            cursor = await db.execute(
+                "UPDATE render_jobs SET lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = ?",
+                (now + self.lease_seconds, now, job_id, owner, RUNNING)
+            )
+            return cursor.rowcount > 0
+
+    async def set_progress(self, job_id: int, text: str):
+        """Сохраняет текст статуса для передачи пользователю"""
+        async with self._lock:
+            db = await self._get_db()
+            await db.execute(
+                "UPDATE render_jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                (text, time.time(), job_id)
+            )
+
+    async def mark_delivered(self, job_id: int):
+        """
+        Отмечает, что результат отправлен пользователю. Без проверки аренды: даже если ее
+        уже забрал другой обработчик, задача не должна выполняться и отправляться повторно.
+        """
+        async with self._lock:
+            db = await self._get_db()
+            now = time.time()
+            await db.execute(
+                "UPDATE render_jobs SET delivered_at = ?, updated_at = ? WHERE id = ?",
+                (now, now, job_id)
+            )
+
+    async def complete(self, job_id: int, owner: str):
+        """Отмечает выполнение; LeaseLostError — задача уже принадлежит другому обработчику"""
+        async with self._lock:
+            db = await self._get_db()
+            cursor = await db.execute(
+                "UPDATE render_jobs SET status = ?, lease_owner = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ?",
+                (DONE, time.time(), job_id, owner)
+            )
+        if not cursor.rowcount:
+            raise LeaseLostError(f"Аренда задачи {job_id} потеряна")
+        logger.info(f"Задача рендера {job_id} выполнена")
+
+    async def fail(self, job_id: int, owner: str, attempts: int, error: str, retry: bool = True) -> bool:
+        """
+        Отмечает неудачу: задача вернется в очередь или уйдет в dead. True — задача мертва.
+        Если результат уже отправлен, задача отмечается выполненной и повтора нет.
+        LeaseLostError — задача уже принадлежит другому обработчику.
+        """
+        dead = not retry or attempts >= self.max_attempts
+        now = time.time()
+        async with self._lock:
+            db = await self._get_db()
+            async with db.execute(
+                "SELECT delivered_at IS NOT NULL FROM render_jobs WHERE id = ?", (job_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            delivered = bool(row and row[0])
+            if delivered:
+                status, dead = DONE, False
+            else:
+                status = DEAD if dead else QUEUED
+            cursor = await db.execute(
+                "UPDATE render_jobs SET status = ?, available_at = ?, lease_owner = NULL, lease_until = NULL, "
+                "error = ?, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                (status, now + self.retry_delay * attempts, error, now, job_id, owner)
+            )
+        if not cursor.rowcount:
+            raise LeaseLostError(f"Аренда задачи {job_id} потеряна")
+        if delivered:
+            logger.warning(f"Задача рендера {job_id} завершилась ошибкой после отправки результата: {error}")
+        elif dead:
+            logger.error(f"Задача рендера {job_id} перенесена в dead после {attempts} попыток: {error}")
+        else:
+            logger.warning(f"Задача рендера {job_id} вернется в очередь (попытка {attempts}): {error}")
+        return dead
+
+    async def get(self, job_id: int) -> tuple[str, str | None] | None:
+        """Возвращает (статус, текст прогресса) задачи"""
+        async with self._lock:
+            db = await self._get_db()
+            async with db.execute(
+                "SELECT status, progress FROM render_jobs WHERE id = ?", (job_id,)
+            ) as cursor:
+                return await cursor.fetchone()
+
+    async def depth(self) -> int:
+        """Сколько задач готово к выдаче и ждет обработчика"""
+        async with self._lock:
+            db = await self._get_db()
+            async with db.execute(
+                "SELECT COUNT(*) FROM render_jobs WHERE status = ? AND available_at <= ?",
+                (QUEUED, time.time())
+            ) as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def purge(self, older_than: float) -> int:
+        """Удаляет завершенные задачи старше older_than секунд"""
+        async with self._lock:
+            db = await self._get_db()
+            cursor = await db.execute(
+                "DELETE FROM render_jobs WHERE status = ? AND updated_at < ?",
+                (DONE, time.time() - older_than)
+            )
+            return cursor.rowcount
+
+
+render_queue = JobQueue(JOBS_DB_PATH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY)
@@ -0,0 +1,133 @@
+import logging
+import mmap
+from collections import OrderedDict
+from config import MEDIA_PROBE_CACHE_SIZE
+from offload import run_io
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class MediaInfo:
+    """Сведения об аудиофайле, полученные одним разбором сразу после загрузки"""
+    __slots__ = (
+        "path", "duration", "bitrate", "codec", "sample_rate",
+        "artist", "title", "cover_offset", "cover_size"
+    )
+
+    def __init__(self, path: str, duration: float, bitrate: int, codec: str, sample_rate: int,
+                 artist: str, title: str, cover_offset: int | None, cover_size: int):
+        self.path = path
+        self.duration = duration
+        self.bitrate = bitrate
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self.artist = artist
+        self.title = title
+        # Смещение картинки в файле (None — данные не лежат подряд, нужен разбор тегов)
+        self.cover_offset = cover_offset
+        self.cover_size = cover_size
+
+    @property
+    def has_cover(self) -> bool:
+        return self.cover_size > 0
+
+
+# Результаты разбора по file_unique_id
+_cache: OrderedDict[str, MediaInfo] = OrderedDict()
+
+
+def _first_text(tags, key: str) -> str:
+    value = tags.get(key) if tags else None
+    if not value:
+        return ""
+    value = value.text if hasattr(value, "text") else value
+    return str(value[0]) if value else ""
+
+
+def _find_offset(path: str, data: bytes) -> int | None:
+    """Ищет картинку в файле, чтобы потом читать ее без разбора тегов"""
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = mm.find(data[:4096])
+            if offset >= 0 and mm[offset:offset + len(data)] == data:
+                return offset
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось найти обложку в {path}: {e}")
+    return None
+
+
+def probe_file(path: str) -> MediaInfo:
+    """Разбирает файл (блокирующая функция): параметры потока, теги и встроенная обложка"""
+    # mutagen загружается при первом разборе, а не при запуске бота
+    import mutagen
+    from mutagen.id3 import APIC
+    from mutagen.mp3 import MP3
+    from mutagen.mp4 import MP4, MP4Cover
+
+    audio = mutagen.File(path)
+    if audio is None:
+        raise ValueError(f"Неизвестный формат аудио: {path}")
+
+    info = audio.info
+    cover_data = None
+    if isinstance(audio, MP3):
+        codec = "mp3"
+        artist, title = _first_text(audio.tags, "TPE1"), _first_text(audio.tags, "TIT2")
+        for tag in (audio.tags or {}).values():
+            if isinstance(tag, APIC):
+                cover_data = tag.data
+                break
+    elif isinstance(audio, MP4):
+        codec = getattr(info, "codec", "") or "mp4a"
+        artist, title = _first_text(audio.tags, "\xa9ART"), _first_text(audio.tags, "\xa9nam")
+        covers = (audio.tags or {}).get("covr")
+        if covers:
+            cover_data = bytes(covers[0]) if isinstance(covers[0], MP4Cover) else covers[0]
+    else:
+        raise ValueError(f"Неподдерживаемый формат аудио: {type(audio).__name__}")
+
+    return MediaInfo(
+        path=path,
+        duration=info.length,
+        bitrate=getattr(info, "bitrate", 0) or 0,
+        codec=codec,
+        sample_rate=getattr(info, "sample_rate", 0) or 0,
+        artist=artist,
+        title=title,
+        cover_offset=_find_offset(path, cover_data) if cover_data else None,
+        cover_size=len(cover_data) if cover_data else 0,
+    )
+
+
+def get_cached(source_id: str | None, path: str) -> MediaInfo | None:
+    """Результат разбора из кэша, если он получен для этого же файла"""
+    info = _cache.get(source_id) if source_id else None
+    if info is None or info.path != path:
+        return None
+    _cache.move_to_end(source_id)
+    return info
+
+
+async def probe(source_id: str | None, path: str, remember: bool = False) -> MediaInfo:
+    """
+    Возвращает сведения о файле из кэша или разбирает его.
+    remember=True — разбор только что загруженного файла, результат кэшируется по source_id;
+    производные файлы (например, обрезанный) разбираются без записи в кэш.
+    """
+    info = get_cached(source_id, path)
+    if info is not None:
+        return info
+
+    info = await run_io(probe_file, path)
+    logger.info(
+        f"Аудио {path}: {info.codec}, {info.duration:.1f} сек, {info.bitrate // 1000} кбит/с, "
+        f"{info.sample_rate} Гц, обложка {info.cover_size} байт"
+    )
+
+    if remember and source_id:
+        _cache[source_id] = info
+        _cache.move_to_end(source_id)
+        while len(_cache) > MEDIA_PROBE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return info
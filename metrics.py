@@ -0,0 +1,175 @@
+import functools
+import inspect
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Callable
+from aiohttp import web
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы длительности этапов (сек)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, math.inf)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Счетчик с одной меткой"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values: dict[str, float] = {}
+
+    def inc(self, label_value: str, amount: float = 1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма с одной меткой в формате Prometheus"""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        # значение метки -> (счетчики по корзинам, сумма, количество)
+        self._series: dict[str, list] = {}
+
+    def observe(self, label_value: str, value: float):
+        series = self._series.setdefault(label_value, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in sorted(self._series.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(
+                    f'{self.name}_bucket{{{self.label}="{label_value}",le="{_format_value(bound)}"}} {bucket_count}'
+                )
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total!r}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {count}')
+        return lines
+
+
+stage_duration = Histogram("winyl_stage_duration_seconds", "Длительность этапов обработки", "stage")
+stage_failures = Counter("winyl_stage_failures_total", "Ошибки этапов обработки", "stage")
+_in_flight: dict[str, int] = {}
+
+# Показатели, которые считываются в момент запроса /metrics:
+# (имя, описание, тип, метка или None, функция -> число или {значение метки: число})
+_gauges: list[tuple[str, str, str, str | None, Callable]] = []
+
+
+def gauge(name: str, help_text: str, callback: Callable, label: str | None = None, kind: str = "gauge"):
+    """Регистрирует показатель; callback может быть корутиной, kind="counter" — для накопительных"""
+    _gauges.append((name, help_text, kind, label, callback))
+
+
+@asynccontextmanager
+async def track(stage: str):
+    """Замеряет этап: длительность, число выполняемых сейчас и ошибки"""
+    _in_flight[stage] = _in_flight.get(stage, 0) + 1
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        stage_failures.inc(stage)
+        raise
+    finally:
+        _in_flight[stage] -= 1
+        stage_duration.observe(stage, time.monotonic() - started)
+
+
+def timed(stage: str, empty_is_failure: bool = False):
+    """Декоратор для async-функций этапа; empty_is_failure — пустой ответ (None, False) считается ошибкой"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with track(stage):
+                result = await func(*args, **kwargs)
+            if empty_is_failure and not result:
+                stage_failures.inc(stage)
+            return result
+        return wrapper
+    return decorator
+
+
+# Готовность процесса принимать обновления и причины, по которым он не готов
+_readiness = {"ready": False, "problems": []}
+
+
+def set_ready(ready: bool, problems: list[str] | None = None):
+    _readiness["ready"] = ready
+    _readiness["problems"] = list(problems or [])
+
+
+gauge("winyl_ready", "Процесс готов принимать обновления", lambda: int(_readiness["ready"]))
+gauge("winyl_stage_in_flight", "Этапы, выполняемые сейчас", lambda: dict(_in_flight), label="stage")
+gauge("winyl_jobs_in_flight", "Задачи видеокружков в работе", lambda: _in_flight.get("job", 0))
+
+
+async def render_metrics() -> str:
+    lines = stage_duration.render() + stage_failures.render()
+    for name, help_text, kind, label, callback in _gauges:
+        try:
+            value = callback()
+            if inspect.isawaitable(value):
+                value = await value
+        except Exception as e:
+            logger.warning(f"Не удалось получить показатель {name}: {e}")
+            continue
+
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if isinstance(value, dict):
+            for label_value, item in sorted(value.items()):
+                lines.append(f'{name}{{{label}="{label_value}"}} {_format_value(item)}')
+        else:
+            lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=await render_metrics(), content_type="text/plain", charset="utf-8")
+
+
+async def _handle_ready(request: web.Request) -> web.Response:
+    if _readiness["ready"]:
+        return web.Response(text="ready\n")
+    text = "\n".join(_readiness["problems"] or ["starting"]) + "\n"
+    return web.Response(status=503, text=text, charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner | None:
+    """Запускает HTTP-сервер с /metrics и /ready; None — сервер не запущен"""
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    app.router.add_get("/ready", _handle_ready)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
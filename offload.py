@@ -0,0 +1,102 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import IO_WORKERS, CPU_WORKERS
+from metrics import gauge
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class _Pool:
+    """Пул исполнителя с учетом задач в работе и в очереди"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.executor: Executor | None = None
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _create(self) -> Executor:
+        if self.name == "cpu":
+            # spawn: дочерние процессы не наследуют event loop и потоки бота
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"winyl-{self.name}")
+
+    async def run(self, func, *args, **kwargs):
+        if self.executor is None:
+            self.executor = self._create()
+        call = functools.partial(func, *args, **kwargs)
+
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+            self.completed += 1
+            return result
+        except BrokenProcessPool:
+            # Рабочий процесс упал — следующий вызов создаст пул заново
+            logger.error(f"Пул {self.name} поврежден, будет пересоздан")
+            self.executor = None
+            self.failed += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.pending,
+            "queue_depth": max(0, self.pending - self.workers),
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+
+_io_pool = _Pool("io", IO_WORKERS)
+_cpu_pool = _Pool("cpu", CPU_WORKERS)
+
+
+async def run_io(func, *args, **kwargs):
+    """Выполняет блокирующий ввод-вывод в пуле потоков, не занимая event loop"""
+    return await _io_pool.run(func, *args, **kwargs)
+
+
+async def run_cpu(func, *args, **kwargs):
+    """
+    Выполняет тяжелую для процессора работу в пуле процессов.
+    func и аргументы должны сериализоваться (функции уровня модуля).
+    """
+    return await _cpu_pool.run(func, *args, **kwargs)
+
+
+gauge("winyl_executor_in_flight", "Задачи в пулах исполнителей",
+      lambda: {name: pool.pending for name, pool in (("io", _io_pool), ("cpu", _cpu_pool))}, label="pool")
+gauge("winyl_executor_queue_depth", "Задачи, ожидающие свободного исполнителя",
+      lambda: {name: pool.stats()["queue_depth"] for name, pool in (("io", _io_pool), ("cpu", _cpu_pool))},
+      label="pool")
+
+
+def shutdown_offload():
+    """Останавливает пулы (при завершении процесса)"""
+    _cpu_pool.shutdown()
+    _io_pool.shutdown()
+    logger.info("Пулы исполнителей остановлены")
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import socket
+import sys
+from config import (
+    JOB_LEASE_SECONDS, JOB_POLL_INTERVAL, METRICS_HOST, METRICS_WORKER_PORT,
+    RENDER_MAX_CONCURRENCY, RENDER_WORKER_PROCESSES, MEMORY_BUDGET_BYTES
+)
+from db import init_db, close_db
+from job_queue import render_queue, LeaseLostError
+from offload import shutdown_offload, run_io
+from metrics import gauge, start_metrics_server
+from startup import warm_up, mark_ready, clear_ready
+from scheduler import render_scheduler
+from budget import memory_budget
+from encoding import encoding_controller
+from utils import ensure_temp_dir, deliver_video_note, RenderError
+from workspace import remove_workspace
+from Winyl import setup_logging, create_bot
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Завершенные задачи хранятся сутки
+DONE_JOBS_TTL = 24 * 3600
+
+
+async def _keep_lease(job_id: int, owner: str, work: asyncio.Task):
+    """Продлевает аренду задачи, пока она выполняется; при потере аренды останавливает работу"""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            alive = await render_queue.heartbeat(job_id, owner)
+        except Exception as e:
+            logger.warning(f"Не удалось продлить аренду задачи {job_id}: {e}")
+            continue
+        if not alive:
+            logger.warning(f"Аренда задачи {job_id} потеряна, выполнение остановлено")
+            work.cancel()
+            return
+
+
+async def process_job(bot, owner: str, job_id: int, payload: dict, attempt: int):
+    """Выполняет одну задачу: рендер, отправка, отметка в очереди"""
+    chat_id = payload["chat_id"]
+
+    async def status(text: str):
+        await render_queue.set_progress(job_id, text)
+
+    async def on_sent():
+        # Отметка до снятия аренды: после сбоя задача не отправится повторно
+        await render_queue.mark_delivered(job_id)
+
+    logger.info(f"Задача {job_id}: попытка {attempt}, чат {chat_id}")
+    work = asyncio.create_task(deliver_video_note(bot, chat_id, payload, status, on_sent))
+    lease = asyncio.create_task(_keep_lease(job_id, owner, work))
+    try:
+        try:
+            await work
+            await render_queue.complete(job_id, owner)
+            await run_io(remove_workspace, payload.get("workspace"))
+        except asyncio.CancelledError:
+            if not lease.done() or lease.cancelled():
+                raise
+            # Аренду потеряли: задачей и ее каталогом теперь владеет другой обработчик
+        except RenderError as e:
+            # Ошибка во входных данных — повтор не поможет
+            # Текст ошибки пользователь увидит в сообщении о статусе задачи
+            await render_queue.set_progress(job_id, f"❌ {e}")
+            await render_queue.fail(job_id, owner, attempt, str(e), retry=False)
+            await run_io(remove_workspace, payload.get("workspace"))
+        except Exception as e:
+            logger.exception(f"Ошибка выполнения задачи {job_id}:")
+            if await render_queue.fail(job_id, owner, attempt, str(e)):
+                await run_io(remove_workspace, payload.get("workspace"))
+    except LeaseLostError as e:
+        logger.warning(f"{e}: результат не записан, задачу выполняет другой обработчик")
+    finally:
+        lease.cancel()
+        work.cancel()
+
+
+async def main():
+    setup_logging()
+    ensure_temp_dir()
+    await init_db()
+    bot = create_bot()
+
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    # Ядра и бюджет памяти машины делятся между процессами render_worker поровну
+    workers = max(1, RENDER_WORKER_PROCESSES)
+    render_scheduler.max_concurrency = max(1, RENDER_MAX_CONCURRENCY // workers)
+    memory_budget.limit = MEMORY_BUDGET_BYTES // workers
+    # Берем из очереди не больше задач, чем можем рендерить одновременно
+    capacity = asyncio.Semaphore(render_scheduler.max_concurrency)
+    running: set[asyncio.Task] = set()
+    logger.info(
+        f"=== Обработчик рендера {owner} запущен (слотов: {render_scheduler.max_concurrency}, "
+        f"память: {memory_budget.limit // (1024 * 1024)} МБ) ==="
+    )
+
+    gauge("winyl_job_queue_depth", "Задачи, готовые к выдаче обработчикам", render_queue.depth)
+    metrics_runner = (
+        await start_metrics_server(METRICS_HOST, METRICS_WORKER_PORT) if METRICS_WORKER_PORT else None
+    )
+
+    purged = await render_queue.purge(DONE_JOBS_TTL)
+    if purged:
+        logger.info(f"Удалено завершенных задач: {purged}")
+
+    try:
+        # Без ffmpeg задачи не берем: они ушли бы в повторы и в мертвые
+        problems = await warm_up()
+        if problems:
+            raise SystemExit(f"Обработчик рендера не готов: {'; '.join(problems)}")
+        mark_ready(problems)
+
+        while True:
+            await capacity.acquire()
+            try:
+                job = await render_queue.claim(owner)
+            except Exception as e:
+                logger.error(f"Ошибка получения задачи: {e}")
+                job = None
+            if job is None:
+                capacity.release()
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            # Глубина очереди учитывается при выборе профиля кодирования
+            try:
+                encoding_controller.backlog = await render_queue.depth()
+            except Exception as e:
+                logger.warning(f"Не удалось получить глубину очереди: {e}")
+
+            task = asyncio.create_task(process_job(bot, owner, *job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: capacity.release())
+    finally:
+        clear_ready()
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await render_queue.close()
+        await bot.session.close()
+        await close_db()
+        shutdown_offload()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nОбработчик рендера остановлен")
+        sys.exit(0)
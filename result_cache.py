@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from functools import lru_cache
+from config import DEFAULT_COVER, RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES
+from db import get_cached_video_note, save_cached_video_note, delete_cached_video_note
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Сколько file_id держим в памяти поверх таблицы в БД
+_MEMORY_ENTRIES = 1024
+
+_file_ids: OrderedDict[str, str] = OrderedDict()
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def _default_cover_hash() -> str:
+    return _hash_file(DEFAULT_COVER)
+
+
+def cover_hash(cover_path: str) -> str:
+    """Хэш содержимого обложки (хэш стандартной обложки считается один раз)"""
+    if cover_path == DEFAULT_COVER:
+        return _default_cover_hash()
+    return _hash_file(cover_path)
+
+
+def make_cache_key(source_id: str, cut_sec: int, cover_path: str, render_params: str) -> str:
+    """Ключ готового видеокружка: исходник, точка обрезки, обложка и параметры рендера"""
+    raw = f"{source_id}|{cut_sec}|{cover_hash(cover_path)}|{render_params}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def get_file_id(cache_key: str) -> str | None:
+    """Возвращает сохраненный file_id видеокружка"""
+    file_id = _file_ids.get(cache_key)
+    if file_id:
+        _file_ids.move_to_end(cache_key)
+        return file_id
+
+    file_id = await get_cached_video_note(cache_key)
+    if file_id:
+        _remember_in_memory(cache_key, file_id)
+    return file_id
+
+
+async def remember_file_id(cache_key: str, file_id: str):
+    """Запоминает file_id, который Telegram вернул после отправки"""
+    _remember_in_memory(cache_key, file_id)
+    await save_cached_video_note(cache_key, file_id)
+
+
+async def forget_file_id(cache_key: str):
+    """Забывает устаревший file_id"""
+    _file_ids.pop(cache_key, None)
+    await delete_cached_video_note(cache_key)
+
+
+def _remember_in_memory(cache_key: str, file_id: str):
+    _file_ids[cache_key] = file_id
+    _file_ids.move_to_end(cache_key)
+    while len(_file_ids) > _MEMORY_ENTRIES:
+        _file_ids.popitem(last=False)
+
+
+def _result_path(cache_key: str) -> str:
+    return os.path.join(RESULT_CACHE_DIR, f"{cache_key}.mp4")
+
+
+def load_bytes(cache_key: str) -> bytes | None:
+    """Читает готовое видео из дискового кэша"""
+    if RESULT_CACHE_MAX_BYTES <= 0:
+        return None
+
+    path = _result_path(cache_key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        # Обновляем время доступа для LRU
+        os.utime(path)
+        return data
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша видео {path}: {e}")
+        return None
+
+
+def cached_path(cache_key: str) -> str | None:
+    """Путь к готовому видео в дисковом кэше (для отправки с диска без чтения в память)"""
+    if RESULT_CACHE_MAX_BYTES <= 0:
+        return None
+
+    path = _result_path(cache_key)
+    try:
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка доступа к кэшу видео {path}: {e}")
+        return None
+
+
+def store_file(cache_key: str, source_path: str):
+    """Копирует готовое видео из файла в дисковый кэш"""
+    try:
+        if RESULT_CACHE_MAX_BYTES <= 0 or os.path.getsize(source_path) > RESULT_CACHE_MAX_BYTES:
+            return
+
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        path = _result_path(cache_key)
+        tmp_path = f"{path}.tmp"
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, path)
+        _evict()
+    except Exception as e:
+        logger.error(f"Ошибка записи кэша видео: {e}")
+
+
+def store_bytes(cache_key: str, data: bytes):
+    """Сохраняет готовое видео в дисковый кэш и вытесняет самые старые записи"""
+    if RESULT_CACHE_MAX_BYTES <= 0 or len(data) > RESULT_CACHE_MAX_BYTES:
+        return
+
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        path = _result_path(cache_key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        _evict()
+    except Exception as e:
+        logger.error(f"Ошибка записи кэша видео: {e}")
+
+
+def _evict():
+    entries = []
+    total = 0
+    for entry in os.scandir(RESULT_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".mp4"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+    entries.sort()
+    while total > RESULT_CACHE_MAX_BYTES and entries:
+        _, size, path = entries.pop(0)
+        try:
+            os.remove(path)
+            total -= size
+            logger.info(f"Вытеснено из кэша видео: {path}")
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+from config import RENDER_MAX_CONCURRENCY, RENDER_PER_USER_LIMIT, RENDER_DEFAULT_ETA
+from metrics import gauge
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Колбэк уведомления об очереди: (позиция, ожидание в секундах)
+PositionCallback = Callable[[int, int], Awaitable[None]]
+
+
+class _Ticket:
+    """Заявка пользователя на слот рендера"""
+
+    def __init__(self, user_id: int, on_position: Optional[PositionCallback]):
+        self.user_id = user_id
+        self.on_position = on_position
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.last_position: Optional[int] = None
+
+
+class RenderScheduler:
+    """
+    Ограничивает число одновременных рендеров.
+    Глобальный лимит + лимит на пользователя, между пользователями — round-robin.
+    """
+
+    def __init__(self, max_concurrency: int, per_user_limit: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_user_limit = max(1, per_user_limit)
+        self._queues: dict[int, deque[_Ticket]] = {}
+        # Порядок обхода пользователей для round-robin
+        self._order: deque[int] = deque()
+        self._active: dict[int, int] = {}
+        self._running = 0
+        # Скользящее среднее длительности рендера
+        self._avg_duration = float(RENDER_DEFAULT_ETA)
+        self._notify_tasks: set[asyncio.Task] = set()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def avg_duration(self) -> float:
+        return self._avg_duration
+
+    def _can_run(self, user_id: int) -> bool:
+        return self._active.get(user_id, 0) < self.per_user_limit
+
+    def _pending_order(self) -> list[_Ticket]:
+        """Порядок, в котором будут выданы слоты ожидающим заявкам"""
+        queues = {uid: list(self._queues[uid]) for uid in self._order}
+        result = []
+        while any(queues.values()):
+            for uid in self._order:
+                if queues[uid]:
+                    result.append(queues[uid].pop(0))
+        return result
+
+    def _dispatch(self):
+        """Выдает свободные слоты по кругу между пользователями"""
+        granted = True
+        while self._running < self.max_concurrency and granted:
+            granted = False
+            for _ in range(len(self._order)):
+                uid = self._order[0]
+                self._order.rotate(-1)
+                queue = self._queues[uid]
+                if not self._can_run(uid):
+                    continue
+
+                ticket = queue.popleft()
+                if not queue:
+                    del self._queues[uid]
+                    self._order.remove(uid)
+                if ticket.future.done():
+                    # Ожидание уже отменено — слот достается следующей заявке
+                    granted = True
+                    break
+                self._active[uid] = self._active.get(uid, 0) + 1
+                self._running += 1
+                ticket.future.set_result(None)
+                granted = True
+                break
+
+        self._notify_positions()
+
+    def _notify_positions(self):
+        """Сообщает ожидающим об их новой позиции в очереди"""
+        for index, ticket in enumerate(self._pending_order()):
+            position = index + 1
+            if ticket.on_position is None or ticket.last_position == position:
+                continue
+            ticket.last_position = position
+            eta = math.ceil(position / self.max_concurrency) * self._avg_duration
+            task = asyncio.create_task(self._safe_notify(ticket, position, int(eta)))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+    @staticmethod
+    async def _safe_notify(ticket: _Ticket, position: int, eta: int):
+        try:
+            await ticket.on_position(position, eta)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить позицию в очереди: {e}")
+
+    def _release(self, user_id: int, elapsed: Optional[float]):
+        self._running -= 1
+        self._active[user_id] -= 1
+        if not self._active[user_id]:
+            del self._active[user_id]
+        if elapsed is not None:
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * elapsed
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_position: Optional[PositionCallback] = None):
+        """Ожидает слот рендера для пользователя и удерживает его на время блока"""
+        ticket = _Ticket(user_id, on_position)
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._order.append(user_id)
+        self._queues[user_id].append(ticket)
+        self._dispatch()
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Слот уже выдан — возвращаем его
+                self._release(user_id, None)
+            else:
+                # Заявку мог уже убрать из очереди _dispatch
+                queue = self._queues.get(user_id)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[user_id]
+                        self._order.remove(user_id)
+                self._dispatch()
+            raise
+
+        logger.info(
+            f"Слот рендера выдан пользователю {user_id} "
+            f"(активно {self._running}/{self.max_concurrency}, в очереди {self.waiting})"
+        )
+        started = time.monotonic()
+        elapsed = None
+        try:
+            yield
+            elapsed = time.monotonic() - started
+        finally:
+            self._release(user_id, elapsed)
+
+
+render_scheduler = RenderScheduler(RENDER_MAX_CONCURRENCY, RENDER_PER_USER_LIMIT)
+
+gauge("winyl_render_running", "Рендеры, выполняемые сейчас", lambda: render_scheduler.running)
+gauge("winyl_render_waiting", "Рендеры в очереди планировщика", lambda: render_scheduler.waiting)
+gauge("winyl_render_avg_seconds", "Скользящее среднее длительности рендера", lambda: render_scheduler.avg_duration)
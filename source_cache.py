@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from config import SOURCE_CACHE_DIR, SOURCE_CACHE_MAX_BYTES
+from metrics import gauge
+from offload import run_io
+from workspace import link_file
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Файлы кэша (имя — file_unique_id с расширением) от старых к новым: имя -> размер
+_entries: OrderedDict[str, int] = OrderedDict()
+_total = 0
+_loaded = False
+
+# Ссылки в каталогах задач на файлы кэша: пока ссылка есть, файл не вытесняется
+_holders: dict[str, set[str]] = {}
+_owners: dict[str, str] = {}
+
+# Исходники, которые сейчас скачиваются: имя -> задача
+_downloading: dict[str, asyncio.Task] = {}
+
+stats = {"hit": 0, "miss": 0, "shared": 0}
+
+
+def _cache_path(name: str) -> str:
+    return os.path.join(SOURCE_CACHE_DIR, name)
+
+
+def _scan() -> list[tuple[str, int]]:
+    """Файлы, оставшиеся от прошлых запусков, от старых к новым"""
+    os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+    found = []
+    for entry in os.scandir(SOURCE_CACHE_DIR):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+    found.sort()
+    return [(name, size) for _, name, size in found]
+
+
+def _file_size(path: str) -> int | None:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _commit(tmp_path: str, path: str) -> int:
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+            logger.info(f"Вытеснено из кэша исходников: {path}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
+
+
+def _add(name: str, size: int):
+    global _total
+    if name in _entries:
+        _total -= _entries[name]
+    _entries[name] = size
+    _entries.move_to_end(name)
+    _total += size
+
+
+def _forget(name: str):
+    global _total
+    _total -= _entries.pop(name, 0)
+
+
+def _in_use(name: str) -> bool:
+    holders = _holders.get(name)
+    if not holders:
+        return False
+    # Каталог задачи могли удалить целиком (finish_job, очистка) — такие ссылки не держат файл
+    for link in [link for link in holders if not os.path.lexists(link)]:
+        holders.discard(link)
+        _owners.pop(link, None)
+    return bool(holders)
+
+
+async def _evict(keep: str):
+    global _total
+    victims = []
+    for name, size in list(_entries.items()):
+        if _total <= SOURCE_CACHE_MAX_BYTES:
+            break
+        if name == keep or _in_use(name):
+            continue
+        del _entries[name]
+        _holders.pop(name, None)
+        _total -= size
+        victims.append(_cache_path(name))
+    if victims:
+        await run_io(_remove_files, victims)
+
+
+async def _download(name: str, path: str, download: Callable[[str], Awaitable[None]]):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        await download(tmp_path)
+        size = await run_io(_commit, tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _add(name, size)
+    logger.info(f"Исходник сохранен в кэш: {path} ({size // 1024} КБ)")
+    await _evict(keep=name)
+
+
+async def fetch(name: str, destination: str, download: Callable[[str], Awaitable[None]]):
+    """
+    Кладет в destination (каталог задачи) ссылку на исходник name из кэша.
+    Если его нет — скачивает через download(path); параллельные запросы одного файла ждут одну загрузку.
+    Каждый процесс ограничивает размер известных ему файлов SOURCE_CACHE_MAX_BYTES.
+    """
+    global _loaded
+    if SOURCE_CACHE_MAX_BYTES <= 0:
+        await download(destination)
+        return
+
+    if not _loaded:
+        _loaded = True
+        for found, size in await run_io(_scan):
+            if found not in _entries:
+                _add(found, size)
+
+    path = _cache_path(name)
+    size = _entries.get(name)
+    if size is None:
+        # Файл мог скачать другой процесс
+        size = await run_io(_file_size, path)
+        if size is not None:
+            _add(name, size)
+
+    if size is not None:
+        stats["hit"] += 1
+        _entries.move_to_end(name)
+        logger.info(f"Исходник взят из кэша: {path}")
+    else:
+        task = _downloading.get(name)
+        if task is None:
+            stats["miss"] += 1
+            task = asyncio.create_task(_download(name, path, download))
+            _downloading[name] = task
+            task.add_done_callback(lambda _: _downloading.pop(name, None))
+        else:
+            stats["shared"] += 1
+            logger.info(f"Исходник уже скачивается, ждем: {path}")
+        await asyncio.shield(task)
+
+    # Удерживаем файл до создания ссылки, чтобы его не вытеснили
+    _holders.setdefault(name, set()).add(destination)
+    _owners[destination] = name
+    try:
+        await run_io(link_file, path, destination)
+    except FileNotFoundError:
+        # Файл успел удалить другой процесс — скачиваем мимо кэша
+        release(destination)
+        _forget(name)
+        await download(destination)
+    except BaseException:
+        release(destination)
+        raise
+
+
+def release(destination: str):
+    """Задача больше не использует файл по ссылке destination"""
+    name = _owners.pop(destination, None)
+    if name is not None and name in _holders:
+        _holders[name].discard(destination)
+
+
+gauge("winyl_source_cache_bytes", "Размер кэша исходников", lambda: _total)
+gauge("winyl_source_cache_requests_total", "Запросы к кэшу исходников", lambda: dict(stats),
+      label="result", kind="counter")
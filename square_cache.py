@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import shutil
+from config import DEFAULT_COVER, SQUARE_CACHE_DIR, SQUARE_CACHE_MAX_ENTRIES
+from result_cache import cover_hash
+from offload import run_io, run_cpu
+from imaging import make_square
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Обложки, которые сейчас преобразуются: хэш обложки -> задача
+_building: dict[str, asyncio.Task] = {}
+
+# Квадратная стандартная обложка в памяти (передается ffmpeg через stdin)
+_default_data: bytes | None = None
+
+
+def _square_path(key: str) -> str:
+    return os.path.join(SQUARE_CACHE_DIR, f"{key}.jpg")
+
+
+def _touch(path: str) -> bool:
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+async def get_square(image_path: str) -> str | None:
+    """
+    Возвращает путь к квадратной обложке 512x512 в кэше.
+    Если ее нет — преобразует (параллельные запросы одной обложки ждут одно преобразование).
+    """
+    try:
+        key = await run_io(cover_hash, image_path)
+    except OSError as e:
+        logger.error(f"Не удалось прочитать обложку {image_path}: {e}")
+        return None
+
+    path = _square_path(key)
+    if await run_io(_touch, path):
+        return path
+
+    task = _building.get(key)
+    if task is None:
+        task = asyncio.create_task(_build(image_path, path))
+        _building[key] = task
+        task.add_done_callback(lambda _: _building.pop(key, None))
+
+    return await asyncio.shield(task)
+
+
+async def _build(image_path: str, path: str) -> str | None:
+    await run_io(os.makedirs, SQUARE_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp.jpg"
+    try:
+        # Декодирование и масштабирование — в пуле процессов, чтобы большая обложка не блокировала бота
+        if not await run_cpu(make_square, image_path, tmp_path):
+            # Обложка уже квадратная — в кэш попадает как есть
+            await run_io(shutil.copyfile, image_path, tmp_path)
+        await run_io(os.replace, tmp_path, path)
+        logger.info(f"Квадратная обложка сохранена: {path}")
+        await run_io(_evict)
+        return path
+    except Exception as e:
+        logger.error(f"Ошибка конвертации в квадрат {image_path}: {e}")
+        return None
+    finally:
+        await run_io(_remove_tmp, tmp_path)
+
+
+def _remove_tmp(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _evict():
+    """Удаляет самые давно использованные обложки сверх лимита"""
+    entries = [
+        (entry.stat().st_mtime, entry.path)
+        for entry in os.scandir(SQUARE_CACHE_DIR)
+        if entry.is_file() and entry.name.endswith(".jpg") and ".tmp" not in entry.name
+    ]
+    entries.sort()
+    while len(entries) > SQUARE_CACHE_MAX_ENTRIES:
+        _, path = entries.pop(0)
+        try:
+            os.remove(path)
+            logger.info(f"Квадратная обложка вытеснена из кэша: {path}")
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def default_cover_data() -> bytes | None:
+    """Квадратная стандартная обложка; готовится один раз и дальше берется из памяти"""
+    global _default_data
+    if _default_data is None and os.path.exists(DEFAULT_COVER):
+        path = await get_square(DEFAULT_COVER)
+        if path:
+            _default_data = await run_io(_read_file, path)
+    return _default_data
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+from config import (
+    TEMP_DIR, WORK_DIR, ASSETS_DIR, DEFAULT_COVER, COVER_LOOP_ENABLED, STARTUP_PREBUILD, READY_FILE
+)
+from metrics import set_ready
+from offload import run_io, run_cpu
+from square_cache import default_cover_data
+from cover_loop import prepare_default_loop
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Кодеки ffmpeg, без которых видеокружок не собрать
+REQUIRED_ENCODERS = ("libx264", "aac")
+
+
+def _make_dirs():
+    for directory in (TEMP_DIR, WORK_DIR, ASSETS_DIR):
+        os.makedirs(directory, exist_ok=True)
+
+
+async def _command_output(*cmd: str) -> str | None:
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+    except OSError as e:
+        logger.error(f"Не удалось запустить {cmd[0]}: {e}")
+        return None
+    return stdout.decode(errors="replace") if process.returncode == 0 else None
+
+
+async def check_ffmpeg() -> list[str]:
+    """Проверяет ffmpeg и нужные кодеки; возвращает список проблем"""
+    if shutil.which("ffmpeg") is None:
+        return ["ffmpeg не найден в PATH"]
+    # Конвейер разбирает файлы через mutagen, ffprobe нужен только для ручной диагностики
+    if shutil.which("ffprobe") is None:
+        logger.warning("ffprobe не найден в PATH")
+
+    encoders = await _command_output("ffmpeg", "-hide_banner", "-encoders")
+    if encoders is None:
+        return ["ffmpeg не отвечает на -encoders"]
+    available = {line.split()[1] for line in encoders.splitlines() if len(line.split()) > 1}
+    return [f"в ffmpeg нет кодека {name}" for name in REQUIRED_ENCODERS if name not in available]
+
+
+async def warm_up(primary: bool = True) -> list[str]:
+    """
+    Однократный прогрев перед приемом обновлений: каталоги, ffmpeg и кодеки,
+    стандартная обложка, пул процессов и (STARTUP_PREBUILD) заранее собранные ресурсы.
+    Возвращает список проблем, из-за которых процесс не готов.
+    """
+    started = time.monotonic()
+    await run_io(_make_dirs)
+    problems = await check_ffmpeg()
+
+    if not os.path.exists(DEFAULT_COVER):
+        # Без стандартной обложки не работают треки без своей обложки
+        problems.append(
+            f"обложка по умолчанию не найдена по пути {DEFAULT_COVER}: "
+            f"загрузите файл default_cover.jpg в папку {ASSETS_DIR}/"
+        )
+
+    # Пул процессов запускается сейчас, а не на первой пользовательской обложке
+    await run_cpu(os.getpid)
+
+    if STARTUP_PREBUILD and not problems:
+        if await default_cover_data() is None:
+            problems.append("стандартная обложка не подготовлена")
+        # Цикл вращения общий для процессов — его собирает основной
+        elif primary and COVER_LOOP_ENABLED and not await prepare_default_loop():
+            problems.append("цикл вращения стандартной обложки не собран")
+
+    for problem in problems:
+        logger.error(f"Процесс не готов: {problem}")
+    logger.info(f"Прогрев завершен за {time.monotonic() - started:.1f} сек")
+    return problems
+
+
+def mark_ready(problems: list[str], ready_file: str | None = READY_FILE):
+    """Объявляет готовность (GET /ready и файл ready_file), если проблем нет"""
+    set_ready(not problems, problems)
+    if problems or not ready_file:
+        return
+    with open(ready_file, "w", encoding="utf-8") as f:
+        f.write(f"{os.getpid()}\n")
+    logger.info(f"Процесс готов, создан файл {ready_file}")
+
+
+def clear_ready(ready_file: str | None = READY_FILE):
+    set_ready(False, ["stopping"])
+    if ready_file and os.path.exists(ready_file):
+        os.remove(ready_file)
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Как часто удаляются брошенные сессии (сек)
+PURGE_INTERVAL = 300
+
+
+class _Record:
+    __slots__ = ("state", "data", "loaded_at", "dirty")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], loaded_at: float):
+        self.state = state
+        self.data = data
+        self.loaded_at = loaded_at
+        self.dirty = False
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite, переживает перезапуск и доступно нескольким процессам.
+    Поверх БД — слой в памяти: несколько update_data одного обработчика
+    объединяются в одну запись, которая выполняется через write_delay секунд.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        session_ttl: float,
+        write_delay: float = 0.2,
+        cache_ttl: float = 5.0,
+        key_builder: KeyBuilder | None = None,
+    ):
+        self.path = path
+        self.session_ttl = session_ttl
+        self.write_delay = write_delay
+        # Сколько секунд прочитанная запись считается актуальной без обращения к БД
+        # (в режиме нескольких процессов должно быть 0)
+        self.cache_ttl = cache_ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db: aiosqlite.Connection | None = None
+        self._records: dict[str, _Record] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._flush_task: asyncio.Task | None = None
+        self._purge_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    async def _get_db(self) -> aiosqlite.Connection:
+        async with self._lock:
+            if self._db is None:
+                db = await aiosqlite.connect(self.path)
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute("PRAGMA synchronous=NORMAL")
+                await db.execute("PRAGMA busy_timeout=5000")
+                await db.execute("""
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """)
+                await db.execute("CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at)")
+                await db.commit()
+                self._db = db
+                self._purge_task = asyncio.create_task(self._purge_loop())
+            return self._db
+
+    async def _load(self, key: StorageKey) -> _Record:
+        db_key = self.key_builder.build(key)
+        record = self._records.get(db_key)
+        now = time.monotonic()
+        if record is not None and (record.dirty or now - record.loaded_at < self.cache_ttl):
+            return record
+
+        db = await self._get_db()
+        async with db.execute("SELECT state, data, updated_at FROM fsm WHERE key = ?", (db_key,)) as cursor:
+            row = await cursor.fetchone()
+
+        # Пока шел запрос, запись могли изменить в памяти — она свежее
+        record = self._records.get(db_key)
+        if record is not None and record.dirty:
+            return record
+
+        if row and time.time() - row[2] < self.session_ttl:
+            record = _Record(row[0], json.loads(row[1]), now)
+        else:
+            record = _Record(None, {}, now)
+        self._records[db_key] = record
+        return record
+
+    def _mark_dirty(self, key: StorageKey, record: _Record):
+        record.dirty = True
+        self._records[self.key_builder.build(key)] = record
+        if self._flush_handle is None and self._flush_task is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.write_delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        """Записывает все измененные сессии одной транзакцией"""
+        try:
+            dirty = [(db_key, record) for db_key, record in self._records.items() if record.dirty]
+            if not dirty:
+                return
+            for _, record in dirty:
+                record.dirty = False
+
+            now = time.time()
+            upserts = []
+            deletes = []
+            for db_key, record in dirty:
+                if record.state is None and not record.data:
+                    deletes.append((db_key,))
+                else:
+                    upserts.append((db_key, record.state, json.dumps(record.data, ensure_ascii=False), now))
+
+            try:
+                db = await self._get_db()
+                if upserts:
+                    await db.executemany(
+                        "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                        upserts
+                    )
+                if deletes:
+                    await db.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+                await db.commit()
+            except Exception as e:
+                logger.error(f"Ошибка записи FSM: {e}")
+                for _, record in dirty:
+                    record.dirty = True
+        finally:
+            self._flush_task = None
+            # Изменения, пришедшие во время записи, уходят следующей пачкой
+            if any(record.dirty for record in self._records.values()) and self._flush_handle is None:
+                loop = asyncio.get_running_loop()
+                self._flush_handle = loop.call_later(self.write_delay, self._start_flush)
+
+    async def _purge_loop(self):
+        """Удаляет брошенные сессии старше session_ttl"""
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL)
+            try:
+                expired_before = time.time() - self.session_ttl
+                cursor = await self._db.execute("DELETE FROM fsm WHERE updated_at < ?", (expired_before,))
+                await self._db.commit()
+                if cursor.rowcount:
+                    logger.info(f"Удалено истекших FSM-сессий: {cursor.rowcount}")
+
+                # Из памяти убираем все, что давно не читалось и уже записано
+                stale_before = time.monotonic() - max(self.cache_ttl, PURGE_INTERVAL)
+                for db_key in [k for k, r in self._records.items() if not r.dirty and r.loaded_at < stale_before]:
+                    del self._records[db_key]
+            except Exception as e:
+                logger.error(f"Ошибка очистки FSM-сессий: {e}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._load(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._load(key)
+        record.data = data.copy()
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(key)).data.copy()
+
+    async def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            self._purge_task = None
+        if self._db is not None:
+            await self._flush()
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            await self._db.close()
+            self._db = None
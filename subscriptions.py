@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from aiogram import Bot
+from config import (
+    SUBSCRIPTION_POSITIVE_TTL,
+    SUBSCRIPTION_NEGATIVE_TTL,
+    SUBSCRIPTION_CACHE_SIZE,
+    SUBSCRIPTION_REFRESH_AHEAD,
+)
+from db import set_subscription, check_access
+from utils import is_user_subscribed
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Пользователь считается активным, если обращался к боту за последние N секунд
+HOT_WINDOW = 600
+
+
+class _Entry:
+    __slots__ = ("status", "channel", "expires_at", "last_access")
+
+    def __init__(self, status: bool, channel: str, expires_at: float):
+        self.status = status
+        self.channel = channel
+        self.expires_at = expires_at
+        self.last_access = time.monotonic()
+
+
+class SubscriptionCache:
+    """
+    Кэш подписок на канал перед is_user_subscribed и check_access.
+    Отдельные TTL для подписанных и неподписанных, один запрос к Telegram
+    на пользователя при параллельных проверках, запись в БД только при смене статуса.
+    """
+
+    def __init__(self, positive_ttl: float, negative_ttl: float, max_size: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._refresher: asyncio.Task | None = None
+
+    def peek(self, user_id: int) -> bool | None:
+        """Возвращает статус из кэша, если запись еще не истекла"""
+        entry = self._entries.get(user_id)
+        if entry is None or entry.expires_at <= time.monotonic():
+            return None
+        entry.last_access = time.monotonic()
+        self._entries.move_to_end(user_id)
+        return entry.status
+
+    async def is_subscribed(self, bot: Bot, user_id: int, channel: str) -> bool:
+        """Проверяет подписку: из кэша или одним запросом к Telegram на пользователя"""
+        status = self.peek(user_id)
+        if status is not None:
+            return status
+
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._verify(bot, user_id, channel))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def has_access(self, user_id: int) -> bool:
+        """Проверка доступа без запроса к Telegram: кэш, затем БД"""
+        status = self.peek(user_id)
+        if status is not None:
+            return status
+        return await check_access(user_id)
+
+    async def _verify(self, bot: Bot, user_id: int, channel: str) -> bool:
+        entry = self._entries.get(user_id)
+        previous = entry.status if entry else await check_access(user_id)
+
+        status = await is_user_subscribed(bot, user_id, channel)
+        ttl = self.positive_ttl if status else self.negative_ttl
+        new_entry = _Entry(status, channel, time.monotonic() + ttl)
+        if entry:
+            new_entry.last_access = entry.last_access
+        self._entries[user_id] = new_entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        if status != previous:
+            await set_subscription(user_id, status)
+        return status
+
+    async def _refresh_loop(self, bot: Bot):
+        """Перепроверяет активных пользователей незадолго до истечения записи"""
+        while True:
+            await asyncio.sleep(max(1, SUBSCRIPTION_REFRESH_AHEAD / 2))
+            now = time.monotonic()
+            due = [
+                (user_id, entry.channel)
+                for user_id, entry in self._entries.items()
+                if entry.status
+                and now - entry.last_access < HOT_WINDOW
+                and entry.expires_at - now < SUBSCRIPTION_REFRESH_AHEAD
+                and user_id not in self._inflight
+            ]
+            for user_id, channel in due:
+                try:
+                    await self._verify(bot, user_id, channel)
+                except Exception as e:
+                    logger.warning(f"Не удалось обновить подписку {user_id}: {e}")
+            if due:
+                logger.info(f"Фоново перепроверено подписок: {len(due)}")
+
+    def start_refresher(self, bot: Bot):
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_loop(bot))
+
+    async def stop_refresher(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+
+subscription_cache = SubscriptionCache(
+    SUBSCRIPTION_POSITIVE_TTL,
+    SUBSCRIPTION_NEGATIVE_TTL,
+    SUBSCRIPTION_CACHE_SIZE,
+)
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods.base import TelegramMethod, TelegramType
+from config import (
+    TELEGRAM_POOL_SIZE, TELEGRAM_KEEPALIVE, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_PER_MINUTE, TELEGRAM_RETRY_ATTEMPTS
+)
+from metrics import gauge
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Методы, которые отправляют или меняют сообщения и попадают под ограничения Telegram
+RATE_LIMITED_METHODS = {
+    "sendMessage", "sendPhoto", "sendAudio", "sendDocument", "sendVideo", "sendVideoNote",
+    "copyMessage", "forwardMessage", "deleteMessage", "deleteMessages",
+    "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+}
+
+# Правки одного сообщения, которые можно схлопнуть: отправляется только последняя
+COALESCED_METHODS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+
+# Фоновые пакетные запросы (уборка старых сообщений): уступают чат ответам пользователю
+BACKGROUND_METHODS = {"deleteMessages"}
+
+# Сколько ограничителей чатов держим в памяти
+_MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate в секунду, не больше capacity подряд. Ожидающие обслуживаются по очереди,
+    фоновые — только когда токен не ждет ни один обычный запрос.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._background_lock = asyncio.Lock()
+        self._waiting = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _delay(self) -> float:
+        """Сколько ждать токена; 0 — токен взят"""
+        now = time.monotonic()
+        self._refill(now)
+        delay = self._paused_until - now
+        if delay <= 0:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            delay = (1 - self._tokens) / self.rate
+        return delay
+
+    async def take(self, background: bool = False):
+        if background:
+            async with self._background_lock:
+                while True:
+                    if not self._waiting:
+                        delay = self._delay()
+                        if delay == 0:
+                            return
+                    else:
+                        # Токен нужен обычным запросам — ждем следующего
+                        delay = 1 / self.rate
+                    await asyncio.sleep(delay)
+
+        self._waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    delay = self._delay()
+                    if delay == 0:
+                        return
+                    await asyncio.sleep(delay)
+        finally:
+            self._waiting -= 1
+
+    def pause(self, seconds: float):
+        """Запрещает запросы на seconds секунд (ответ RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """
+    Темп исходящих запросов к Bot API: общий лимит и лимит на чат, повтор после RetryAfter
+    и схлопывание частых правок одного сообщения (статусы задачи) в последнюю.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chats: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        # (метод, чат, сообщение) -> [последняя правка, будущий ответ]
+        self._pending_edits: dict[tuple, list] = {}
+        # Запросы правок идут отдельными задачами: отмена одного ожидающего не отменяет остальных
+        self._edit_tasks: set[asyncio.Task] = set()
+        self.retries = 0
+        self.coalesced = 0
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(TELEGRAM_GROUP_PER_MINUTE / 60, TELEGRAM_CHAT_BURST)
+            else:
+                bucket = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+            self._chats[chat_id] = bucket
+            while len(self._chats) > _MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _throttle(self, chat_id: int | str | None, background: bool = False):
+        # Сначала чат: занятый чат не должен держать общий токен
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).take(background)
+        await self._global.take(background)
+
+    async def _send(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+        chat_id: int | str | None,
+        background: bool = False
+    ) -> TelegramType:
+        attempt = 0
+        while True:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > TELEGRAM_RETRY_ATTEMPTS:
+                    raise
+                self.retries += 1
+                logger.warning(
+                    f"Flood control на {method.__api_method__} (чат {chat_id}): "
+                    f"повтор через {e.retry_after} сек, попытка {attempt}"
+                )
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    self._global.pause(e.retry_after)
+                await self._throttle(chat_id, background)
+
+    async def _send_edit(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        key: tuple,
+        entry: list,
+        chat_id: int | str | None
+    ) -> TelegramType:
+        try:
+            await self._throttle(chat_id)
+        finally:
+            # Правки, пришедшие после этого момента, уйдут отдельным запросом
+            if self._pending_edits.get(key) is entry:
+                del self._pending_edits[key]
+        return await self._send(make_request, bot, entry[0], chat_id)
+
+    def _edit_done(self, task: asyncio.Task):
+        self._edit_tasks.discard(task)
+        # Все ожидающие могли быть отменены — помечаем исключение полученным
+        if not task.cancelled():
+            task.exception()
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> TelegramType:
+        api_method = method.__api_method__
+        if api_method not in RATE_LIMITED_METHODS:
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        if api_method not in COALESCED_METHODS:
+            background = api_method in BACKGROUND_METHODS
+            await self._throttle(chat_id, background)
+            return await self._send(make_request, bot, method, chat_id, background)
+
+        key = (
+            api_method, chat_id,
+            getattr(method, "message_id", None), getattr(method, "inline_message_id", None)
+        )
+        pending = self._pending_edits.get(key)
+        if pending is not None:
+            # Правка еще ждет очереди — заменяем ее текст новым и ждем общий ответ
+            pending[0] = method
+            self.coalesced += 1
+            return await asyncio.shield(pending[1])
+
+        entry = [method, None]
+        self._pending_edits[key] = entry
+        entry[1] = asyncio.create_task(self._send_edit(make_request, bot, key, entry, chat_id))
+        self._edit_tasks.add(entry[1])
+        entry[1].add_done_callback(self._edit_done)
+        return await asyncio.shield(entry[1])
+
+
+class TelegramSession(AiohttpSession):
+    """Сессия Bot API с пулом keep-alive соединений и контролем темпа запросов"""
+
+    def __init__(self, api: TelegramAPIServer = PRODUCTION, **kwargs):
+        super().__init__(api=api, limit=TELEGRAM_POOL_SIZE, **kwargs)
+        self._connector_init["keepalive_timeout"] = TELEGRAM_KEEPALIVE
+        self.flood_control = FloodControlMiddleware()
+        self.middleware(self.flood_control)
+
+
+_sessions: list[TelegramSession] = []
+
+
+def create_session(api: TelegramAPIServer = PRODUCTION) -> TelegramSession:
+    session = TelegramSession(api=api)
+    _sessions.append(session)
+    return session
+
+
+gauge(
+    "winyl_telegram_retry_after_total", "Повторы запросов после RetryAfter",
+    lambda: sum(s.flood_control.retries for s in _sessions), kind="counter"
+)
+gauge(
+    "winyl_telegram_edits_coalesced_total", "Правки сообщений, схлопнутые в более позднюю",
+    lambda: sum(s.flood_control.coalesced for s in _sessions), kind="counter"
+)
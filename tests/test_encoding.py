@@ -0,0 +1,47 @@
+import asyncio
+import hashlib
+import cover_loop
+import utils
+from encoding import PROFILES, ProfileController, default_profile
+from result_cache import cover_hash
+from video import video_filter
+
+# Самый быстрый профиль — тот, что контроллер выбирает под нагрузкой
+FASTEST = list(PROFILES.values())[-1]
+
+
+def test_loop_key_always_uses_default_profile(tmp_path):
+    cover = tmp_path / "cover.jpg"
+    cover.write_bytes(b"cover")
+    raw = f"{cover_hash(str(cover))}|{video_filter(default_profile.size)}|{default_profile.describe()}"
+    assert cover_loop._loop_key(str(cover)) == hashlib.sha256(raw.encode()).hexdigest()
+
+
+def test_loop_render_ignores_chosen_profile(monkeypatch):
+    built = []
+
+    async def get_cover_loop(cover_path):
+        built.append(cover_path)
+        return "/loops/cover.mp4"
+
+    async def from_loop(**kwargs):
+        return b"video"
+
+    monkeypatch.setattr(utils, "get_cover_loop", get_cover_loop)
+    monkeypatch.setattr(utils, "make_video_from_loop_bytes", from_loop)
+    video, profile, mode = asyncio.run(
+        utils.render_video_note("audio.mp3", "cover.jpg", 0, 30, FASTEST, use_loop=True)
+    )
+    assert (video, profile, mode) == (b"video", default_profile, "loop")
+    assert built == ["cover.jpg"]
+
+
+def test_controller_adapts_on_full_renders_only():
+    controller = ProfileController(target_seconds=10, window=5)
+    for _ in range(5):
+        controller.record(100, "loop")
+    assert controller.choose(0, 4) is default_profile
+
+    for _ in range(5):
+        controller.record(100)
+    assert controller.choose(0, 4) is not default_profile
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import pytest
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+import utils
+import workspace
+
+TOKEN = "123456:AAEhBP0av28e7VCqJN1IPdYk0gMXZqQoTQk"
+
+# Больше лимита облачного Bot API (20 МБ)
+LARGE_FILE_SIZE = 25 * 1024 * 1024
+
+
+async def _run(tmp_path, file_path: str, file_size: int, scenario):
+    """Поднимает заглушку локального telegram-bot-api и вызывает scenario(bot, requests)"""
+    requests = []
+
+    async def get_file(request: web.Request):
+        requests.append("getFile")
+        return web.json_response({"ok": True, "result": {
+            "file_id": "file-id", "file_unique_id": "unique-id",
+            "file_size": file_size, "file_path": file_path,
+        }})
+
+    async def file_endpoint(request: web.Request):
+        requests.append(f"file:{request.match_info['path']}")
+        return web.Response(body=b"served over http")
+
+    app = web.Application()
+    app.router.add_post(f"/bot{TOKEN}/getFile", get_file)
+    app.router.add_get(f"/file/bot{TOKEN}/{{path:.+}}", file_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    api = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}", is_local=True)
+    bot = Bot(TOKEN, session=AiohttpSession(api=api))
+    try:
+        await scenario(bot, requests)
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+
+def _local_file(tmp_path, size: int = 4) -> str:
+    path = tmp_path / "server" / "music" / "file_1.mp3"
+    path.parent.mkdir(parents=True)
+    with open(path, "wb") as f:
+        f.truncate(size)
+    return str(path)
+
+
+def test_local_file_is_hardlinked(tmp_path):
+    source = _local_file(tmp_path)
+    destination = str(tmp_path / "audio.mp3")
+
+    async def scenario(bot, requests):
+        await utils.fetch_file(bot, "file-id", destination)
+        assert requests == ["getFile"]
+
+    asyncio.run(_run(tmp_path, source, 4, scenario))
+    assert not os.path.islink(destination)
+    assert os.path.samefile(source, destination)
+    assert os.stat(source).st_nlink == 2
+
+
+def test_local_file_falls_back_to_symlink(tmp_path, monkeypatch):
+    source = _local_file(tmp_path)
+    destination = str(tmp_path / "audio.mp3")
+
+    def cross_device(src, dst):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(workspace.os, "link", cross_device)
+
+    async def scenario(bot, requests):
+        await utils.fetch_file(bot, "file-id", destination)
+        assert requests == ["getFile"]
+
+    asyncio.run(_run(tmp_path, source, 4, scenario))
+    assert os.path.islink(destination)
+    assert os.readlink(destination) == os.path.abspath(source)
+
+
+def test_unreachable_local_file_is_read_over_http(tmp_path):
+    # Каталог сервера не смонтирован в этот процесс: путь из getFile не существует
+    missing = "/var/lib/telegram-bot-api/music/file_1.mp3"
+    destination = str(tmp_path / "audio.mp3")
+
+    async def scenario(bot, requests):
+        await utils.fetch_file(bot, "file-id", destination)
+        assert requests == ["getFile", f"file:{missing}"]
+
+    asyncio.run(_run(tmp_path, missing, 16, scenario))
+    with open(destination, "rb") as f:
+        assert f.read() == b"served over http"
+
+
+def test_large_file_is_accepted_in_local_mode(tmp_path):
+    source = _local_file(tmp_path, LARGE_FILE_SIZE)
+    destination = str(tmp_path / "audio.mp3")
+
+    async def scenario(bot, requests):
+        utils.check_download_size(bot, LARGE_FILE_SIZE)
+        await utils.fetch_file(bot, "file-id", destination, LARGE_FILE_SIZE)
+
+    asyncio.run(_run(tmp_path, source, LARGE_FILE_SIZE, scenario))
+    assert os.path.getsize(destination) == LARGE_FILE_SIZE
+
+
+def test_large_file_is_rejected_by_cloud_api():
+    async def scenario():
+        bot = Bot(TOKEN)
+        try:
+            with pytest.raises(utils.FileTooLargeError):
+                utils.check_download_size(bot, LARGE_FILE_SIZE)
+        finally:
+            await bot.session.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,35 @@
+import asyncio
+from scheduler import RenderScheduler
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        scheduler = RenderScheduler(1, 1)
+        gate = asyncio.Event()
+        order = []
+
+        async def job(user_id: int, hold: asyncio.Event | None = None):
+            async with scheduler.slot(user_id):
+                order.append(user_id)
+                if hold is not None:
+                    await hold.wait()
+
+        holder = asyncio.create_task(job(1, gate))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(job(2))
+        third = asyncio.create_task(job(3))
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 2
+
+        # Слот освобождается в тот же момент, когда ожидание отменяют
+        gate.set()
+        waiter.cancel()
+        await asyncio.wait_for(asyncio.gather(holder, third), 1)
+        assert waiter.cancelled()
+        return scheduler, order
+
+    scheduler, order = asyncio.run(scenario())
+    assert order == [1, 3]
+    assert scheduler.running == 0
+    assert scheduler.waiting == 0
+    assert scheduler._active == {}
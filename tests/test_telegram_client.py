@@ -0,0 +1,67 @@
+import asyncio
+from aiogram.methods import DeleteMessages, EditMessageText, SendMessage
+from telegram_client import FloodControlMiddleware, TokenBucket
+
+CHAT_ID = 42
+
+
+def test_cancelled_first_editor_does_not_cancel_others():
+    async def scenario():
+        middleware = FloodControlMiddleware()
+        # Токены чата кончились: правки ждут очереди и схлопываются
+        middleware._chat_bucket(CHAT_ID)._tokens = 0
+        sent = []
+
+        async def make_request(bot, method):
+            sent.append(method.text)
+            return method.text
+
+        first = asyncio.create_task(middleware(make_request, None, EditMessageText(
+            chat_id=CHAT_ID, message_id=1, text="первая"
+        )))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(middleware(make_request, None, EditMessageText(
+            chat_id=CHAT_ID, message_id=1, text="вторая"
+        )))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        assert await second == "вторая"
+        assert first.cancelled()
+        assert sent == ["вторая"]
+
+    asyncio.run(scenario())
+
+
+def test_background_deletes_yield_to_replies():
+    async def scenario():
+        middleware = FloodControlMiddleware()
+        bucket = middleware._chat_bucket(CHAT_ID)
+        bucket.rate = 20
+        bucket._tokens = 0
+        sent = []
+
+        async def make_request(bot, method):
+            sent.append(method.__api_method__)
+            return True
+
+        delete = asyncio.create_task(middleware(make_request, None, DeleteMessages(
+            chat_id=CHAT_ID, message_ids=[1, 2, 3]
+        )))
+        await asyncio.sleep(0)
+        replies = [
+            asyncio.create_task(middleware(make_request, None, SendMessage(chat_id=CHAT_ID, text="ответ")))
+            for _ in range(2)
+        ]
+        await asyncio.gather(delete, *replies)
+        assert sent == ["sendMessage", "sendMessage", "deleteMessages"]
+
+    asyncio.run(scenario())
+
+
+def test_background_take_uses_idle_bucket():
+    async def scenario():
+        bucket = TokenBucket(rate=1, capacity=1)
+        await asyncio.wait_for(bucket.take(background=True), 0.1)
+
+    asyncio.run(scenario())
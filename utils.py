@@ -2,15 +2,34 @@
 import asyncio
 import logging
 import io
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC
-from mutagen.mp4 import MP4, MP4Cover
-from aiogram.types import Message, BufferedInputFile
+import math
+import shutil
+import time
+from typing import Awaitable, Callable
+import aiofiles
+from aiogram.types import Message, BufferedInputFile, FSInputFile
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest
-from PIL import Image, UnidentifiedImageError
-from config import TEMP_DIR, DEFAULT_COVER
-from video import make_rotating_circle_video_bytes
+from config import (
+    TEMP_DIR, DEFAULT_COVER, COVER_LOOP_ENABLED, CLOUD_DOWNLOAD_LIMIT, LOCAL_DOWNLOAD_LIMIT, LOCAL_DOWNLOAD_TIMEOUT,
+    STATUS_UPDATE_INTERVAL, FFMPEG_PROCESS_BYTES, FFMPEG_MUX_BYTES, VIDEO_BYTES_PER_SECOND, UPLOAD_FROM_FILE
+)
+from video import (
+    make_rotating_circle_video_bytes, make_video_from_loop_bytes, run_ffmpeg, build_ffmpeg_cmd,
+    RENDER_PARAMS, ProgressCallback
+)
+from cover_loop import get_cover_loop, cached_cover_loop
+from workspace import remove_workspace, link_file, mark_in_progress, is_workspace
+import source_cache
+from offload import run_io
+from square_cache import get_square, default_cover_data
+from media_probe import MediaInfo, probe
+from scheduler import render_scheduler
+from encoding import EncodingProfile, encoding_controller, default_profile
+from db import save_render_stats
+from metrics import timed, track, stage_duration, stage_failures
+from budget import memory_budget
+import result_cache
 
 # Создаем временную директорию если не существует
 def ensure_temp_dir():
@@ -21,8 +40,66 @@ def ensure_temp_dir():
     else:
         logging.info(f"Временная директория уже существует: {TEMP_DIR}")
 
+class FileTooLargeError(ValueError):
+    """Файл больше, чем бот может скачать через текущий Bot API сервер"""
+
+# Проверяем, что файл можно скачать через текущий Bot API сервер
+def check_download_size(bot: Bot, file_size: int | None):
+    limit = LOCAL_DOWNLOAD_LIMIT if bot.session.api.is_local else CLOUD_DOWNLOAD_LIMIT
+    if file_size and file_size > limit:
+        raise FileTooLargeError(f"Файл слишком большой: максимум {limit // (1024 * 1024)} МБ.")
+
+# Получаем файл с сервера Telegram в destination
+async def fetch_file(bot: Bot, file_id: str, destination: str, file_size: int | None = None):
+    """
+    Скачивает файл по file_id. С локальным Bot API сервером файл уже лежит на диске:
+    вместо копирования ставим на него жесткую (или символическую) ссылку. Если файлы сервера
+    этому процессу не видны (другой контейнер), читаем файл через HTTP с адреса файлов сервера.
+    Загрузка занимает file_size байт бюджета памяти, пока идет.
+    """
+    # Получаем информацию о файле
+    file = await bot.get_file(file_id)
+    api = bot.session.api
+    if api.is_local:
+        local_path = str(api.wrap_local_file.to_local(file.file_path))
+        if await run_io(os.path.isfile, local_path):
+            await run_io(link_file, local_path, destination)
+            return
+
+    # Загружаем файл
+    async with memory_budget.reserve(file_size or file.file_size or 0):
+        if api.is_local:
+            # Bot.download_file с локальным сервером читает тот же недоступный путь
+            await _download_over_http(bot, file.file_path, destination)
+        else:
+            await bot.download_file(file.file_path, destination=destination)
+
+async def _download_over_http(bot: Bot, file_path: str, destination: str):
+    url = bot.session.api.file_url(bot.token, file_path)
+    async with aiofiles.open(destination, "wb") as f:
+        async for chunk in bot.session.stream_content(
+            url=url, timeout=LOCAL_DOWNLOAD_TIMEOUT, chunk_size=65536, raise_for_status=True
+        ):
+            await f.write(chunk)
+    logging.info(f"Файл прочитан с адреса файлов локального сервера: {file_path}")
+
+# Получаем исходник (аудио или обложку) через кэш по file_unique_id
+async def fetch_source(bot: Bot, file_id: str, name: str, destination: str, file_size: int | None = None):
+    """
+    Повторно присланный файл берется из кэша исходников, одновременные запросы
+    одного файла ждут одну загрузку. С локальным Bot API кэш не нужен.
+    """
+    async def download(path: str):
+        await fetch_file(bot, file_id, path, file_size)
+
+    if bot.session.api.is_local:
+        await download(destination)
+    else:
+        await source_cache.fetch(name, destination, download)
+
 # Сохраняем аудиофайл из сообщения
-async def save_audio(message: Message) -> str:
+@timed("save_audio")
+async def save_audio(message: Message, work_dir: str = TEMP_DIR) -> str:
     # Поддерживаемые MIME-типы
     mime_types = ["audio/mpeg", "audio/mp4", "audio/x-m4a"]
     
@@ -42,13 +119,13 @@ async def save_audio(message: Message) -> str:
     else:
         raise ValueError("Поддерживаются только mp3 и m4a файлы.")
 
-    file_path = os.path.join(TEMP_DIR, f"{unique_id}{ext}")
+    file_size = (message.document or message.audio).file_size
+    check_download_size(message.bot, file_size)
+
+    file_path = os.path.join(work_dir, f"{unique_id}{ext}")
     
     try:
-        # Получаем информацию о файле
-        file = await message.bot.get_file(file_id)
-        # Загружаем файл
-        await message.bot.download_file(file.file_path, destination=file_path)
+        await fetch_source(message.bot, file_id, f"{unique_id}{ext}", file_path, file_size)
         
         logging.info(f"Аудио сохранено: {file_path}")
         return file_path
@@ -57,7 +134,34 @@ async def save_audio(message: Message) -> str:
         raise RuntimeError("Не удалось загрузить аудиофайл")
 
 # Извлекаем обложку из аудиофайла
-async def extract_cover(audio_path: str) -> str | None:
+@timed("extract_cover")
+async def extract_cover(audio_path: str, info: MediaInfo | None = None) -> str | None:
+    # Результат разбора файла подсказывает, есть ли обложка и где она лежит
+    if info is not None and info.path == audio_path:
+        if not info.has_cover:
+            logging.info(f"Обложка не найдена в файле: {audio_path}")
+            return None
+        if info.cover_offset is not None:
+            return await run_io(_read_cover_range, audio_path, info.cover_offset, info.cover_size)
+
+    # Разбор тегов, проверка и запись картинки — блокирующие, выполняем в пуле потоков
+    return await run_io(_extract_cover_sync, audio_path)
+
+def _read_cover_range(audio_path: str, offset: int, size: int) -> str | None:
+    try:
+        with open(audio_path, "rb") as f:
+            f.seek(offset)
+            cover_data = f.read(size)
+        return _write_cover(audio_path, cover_data)
+    except Exception as e:
+        logging.error(f"Ошибка извлечения обложки: {e}")
+        return None
+
+def _extract_cover_sync(audio_path: str) -> str | None:
+    # mutagen загружается при первом разборе тегов, а не при запуске бота
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3, APIC
+    from mutagen.mp4 import MP4, MP4Cover
     try:
         # Определяем формат по расширению
         ext = os.path.splitext(audio_path)[1].lower()
@@ -83,7 +187,8 @@ async def extract_cover(audio_path: str) -> str | None:
                 
             cover_data = audio['covr'][0]
             if isinstance(cover_data, MP4Cover):
-                cover_data = cover_data.data
+                # MP4Cover — подкласс bytes, атрибута data у него нет
+                cover_data = bytes(cover_data)
         
         # Неподдерживаемый формат
         else:
@@ -92,14 +197,23 @@ async def extract_cover(audio_path: str) -> str | None:
         
         if not cover_data:
             return None
-            
-        cover_path = os.path.join(TEMP_DIR, f"meta_cover_{os.path.basename(audio_path)}.jpg")
+        return _write_cover(audio_path, cover_data)
         
-        # Проверяем валидность изображения
+    except Exception as e:
+        logging.error(f"Ошибка извлечения обложки: {e}")
+        return None
+
+def _write_cover(audio_path: str, cover_data: bytes) -> str | None:
+    from PIL import Image, UnidentifiedImageError
+    try:
+        # Обложка кладется рядом с аудио (в каталог задачи)
+        cover_path = os.path.join(os.path.dirname(audio_path), f"meta_cover_{os.path.basename(audio_path)}.jpg")
+        
+        # Проверяем валидность изображения: достаточно разобрать заголовок, не декодируя картинку
         try:
-            img = Image.open(io.BytesIO(cover_data))
-            img.verify()
-            img.close()
+            with Image.open(io.BytesIO(cover_data)) as img:
+                if not img.width or not img.height:
+                    raise OSError("пустое изображение")
         except (UnidentifiedImageError, OSError) as e:
             logging.warning(f"Обложка повреждена: {e}")
             return None
@@ -115,17 +229,17 @@ async def extract_cover(audio_path: str) -> str | None:
         return None
 
 # Сохраняем пользовательскую обложку
-async def save_cover(message: Message) -> str:
+@timed("save_cover")
+async def save_cover(message: Message, work_dir: str = TEMP_DIR) -> str:
     photo = message.photo[-1]  # Берем самое качественное фото
     file_id = photo.file_id
     unique_id = photo.file_unique_id
-    file_path = os.path.join(TEMP_DIR, f"{unique_id}.jpg")
+    check_download_size(message.bot, photo.file_size)
+
+    file_path = os.path.join(work_dir, f"{unique_id}.jpg")
     
     try:
-        # Получаем информацию о файле
-        file = await message.bot.get_file(file_id)
-        # Загружаем файл
-        await message.bot.download_file(file.file_path, destination=file_path)
+        await fetch_source(message.bot, file_id, f"{unique_id}.jpg", file_path, photo.file_size)
         
         logging.info(f"Обложка сохранена: {file_path}")
         return file_path
@@ -134,38 +248,29 @@ async def save_cover(message: Message) -> str:
         raise RuntimeError("Не удалось загрузить обложку")
 
 # Обрезаем аудио до 60 секунд
+@timed("cut_audio")
 async def cut_audio_async(audio_path: str, start_sec: int) -> str:
     # Восстанавливаем оригинальное имя файла с правильным расширением
     base_name = os.path.basename(audio_path)
     name, ext = os.path.splitext(base_name)
-    output_path = os.path.join(TEMP_DIR, f"cut_{name}{ext}")
+    output_path = os.path.join(os.path.dirname(audio_path), f"cut_{name}{ext}")
     
-    cmd = [
-        "ffmpeg", "-y", 
-        "-ss", str(start_sec), 
+    cmd = build_ffmpeg_cmd(
+        "-y",
+        "-ss", str(start_sec),
         "-i", audio_path,
-        "-t", "60", 
+        "-t", "60",
         "-c", "copy",  # Используем копирование без перекодировки
         output_path
-    ]
-    
-    logging.info(f"Выполнение команды обрезки: {' '.join(cmd)}")
-    
-    proc = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.DEVNULL,
-        stderr=asyncio.subprocess.PIPE
     )
     
-    _, stderr = await proc.communicate()
+    success, _ = await run_ffmpeg(cmd, duration=60)
     
-    if proc.returncode == 0:
+    if success:
         logging.info(f"Аудио обрезано: {output_path}")
         return output_path
     else:
-        error_msg = stderr.decode() if stderr else "Неизвестная ошибка"
-        logging.error(f"Ошибка обрезки аудио: {error_msg}")
-        raise RuntimeError(f"Ошибка обрезки аудио: {error_msg}")
+        raise RuntimeError("Ошибка обрезки аудио")
 
 # Проверяем подписку пользователя
 async def is_user_subscribed(bot: Bot, user_id: int, channel: str) -> bool:
@@ -190,6 +295,9 @@ async def remove_temp_file(path: str):
 
 # Получаем метаданные трека
 def get_track_metadata(audio_path: str) -> dict:
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3
+    from mutagen.mp4 import MP4
     try:
         # Определяем формат по расширению
         ext = os.path.splitext(audio_path)[1].lower()
@@ -213,24 +321,24 @@ def get_track_metadata(audio_path: str) -> dict:
         return {"artist": "", "title": ""}
 
 # Конвертируем обложку в квадрат 512x512
+@timed("convert_to_square")
 async def convert_to_square(image_path: str) -> str:
     """Гарантирует квадратный формат 512x512 с сохранением пропорций"""
     try:
-        # Проверяем, не является ли изображение уже квадратным
-        with Image.open(image_path) as img:
-            if img.size == (512, 512) and img.mode == "RGB":
-                logging.info(f"Обложка уже квадратная: {image_path}")
-                return image_path
-
-        # Создаем новое квадратное изображение
-        output_path = os.path.join(TEMP_DIR, f"square_{os.path.basename(image_path)}")
-        img = Image.open(image_path).convert("RGB")
-        img = img.resize((512, 512), Image.LANCZOS)
-        img.save(output_path, "JPEG", quality=90)
+        output_dir = TEMP_DIR if image_path == DEFAULT_COVER else os.path.dirname(image_path)
+        output_path = os.path.join(output_dir, f"square_{os.path.basename(image_path)}")
+
+        # Одна и та же обложка преобразуется один раз, дальше берется из кэша по хэшу содержимого
+        square_path = await get_square(image_path)
+        if not square_path:
+            return image_path
+        await run_io(shutil.copyfile, square_path, output_path)
+
         logging.info(f"Обложка преобразована в квадрат: {output_path}")
         
-        # Удаляем оригинал если это не дефолтная обложка
-        if image_path != DEFAULT_COVER:
+        # Удаляем оригинал, если это не дефолтная обложка. Файл каталога задачи остается:
+        # на него ссылается задача в очереди (повтор после сбоя), каталог удаляется целиком
+        if image_path != DEFAULT_COVER and not is_workspace(os.path.dirname(image_path)):
             await remove_temp_file(image_path)
             
         return output_path
@@ -238,58 +346,337 @@ async def convert_to_square(image_path: str) -> str:
         logging.error(f"Ошибка конвертации в квадрат: {e}")
         return image_path
 
-# Отправляем результат пользователю
-async def send_result(message: Message, state):
-    try:
-        data = await state.get_data()
-        audio_path = data.get("audio_path")
-        cover_path = data.get("cover_path") or DEFAULT_COVER
-        start_time = data.get("start_time", 0)
-        
-        if not audio_path or not os.path.exists(audio_path):
-            logging.error("Аудиофайл не найден")
-            await message.answer("❌ Ошибка: аудиофайл не найден")
+# Повторно отправляем готовый видеокружок из кэша
+async def send_cached_result(bot: Bot, chat_id: int, cache_key: str) -> bool:
+    """Отправляет видеокружок по сохраненному file_id или из дискового кэша"""
+    file_id = await result_cache.get_file_id(cache_key)
+    if file_id:
+        try:
+            async with track("send_video_note"):
+                await bot.send_video_note(chat_id, file_id)
+            logging.info(f"Видеокружок отправлен из кэша по file_id: {cache_key}")
+            return True
+        except TelegramBadRequest as e:
+            logging.warning(f"Сохраненный file_id устарел: {e}")
+            await result_cache.forget_file_id(cache_key)
+
+    path = await run_io(result_cache.cached_path, cache_key)
+    if not path:
+        return False
+
+    if UPLOAD_FROM_FILE:
+        sent = await _send_video_file(bot, chat_id, FSInputFile(path, filename="video_note.mp4"))
+    else:
+        size = await run_io(os.path.getsize, path)
+        async with memory_budget.reserve(size):
+            video_bytes = await run_io(result_cache.load_bytes, cache_key)
+            if not video_bytes:
+                return False
+            sent = await _send_video_file(bot, chat_id, BufferedInputFile(video_bytes, filename="video_note.mp4"))
+    if sent.video_note:
+        await result_cache.remember_file_id(cache_key, sent.video_note.file_id)
+    logging.info(f"Видеокружок отправлен из дискового кэша: {cache_key}")
+    return True
+
+async def _send_video_file(bot: Bot, chat_id: int, video_file, **kwargs) -> Message:
+    async with track("send_video_note"):
+        return await bot.send_video_note(chat_id, video_file, **kwargs)
+
+# Рендерим видеокружок (через цикл вращения, если возможно)
+@timed("render")
+async def render_video_note(
+    audio_path: str,
+    cover_path: str,
+    start_time: int,
+    duration: float,
+    profile: EncodingProfile | None = None,
+    on_progress: ProgressCallback | None = None,
+    output_path: str | None = None,
+    use_loop: bool = COVER_LOOP_ENABLED
+) -> tuple[bytes | str | None, EncodingProfile, str]:
+    """
+    Возвращает (видео, профиль, способ): видео — bytes, при output_path — путь к записанному файлу,
+    способ — "loop" (кадры цикла копируются без кодирования) или "full".
+    Цикл вращения при необходимости собирается (libx264) — вызывающий резервирует память полного рендера.
+    Циклы всегда в профиле по умолчанию; profile (по умолчанию — default_profile) применяется к полному рендеру.
+    """
+    if use_loop:
+        loop_path = await get_cover_loop(cover_path)
+        if loop_path:
+            video_bytes = await make_video_from_loop_bytes(
+                loop_path=loop_path,
+                audio_path=audio_path,
+                start_time=start_time,
+                duration=duration,
+                on_progress=on_progress,
+                output_path=output_path
+            )
+            if video_bytes:
+                return video_bytes, default_profile, "loop"
+        logging.warning("Сборка из цикла не удалась, выполняю полный рендер")
+
+    profile = profile or default_profile
+    # Стандартная обложка уже подготовлена в памяти и передается ffmpeg через stdin
+    cover_data = await default_cover_data() if cover_path == DEFAULT_COVER else None
+    video = await make_rotating_circle_video_bytes(
+        audio_path=audio_path,
+        cover_path=cover_path,
+        cover_data=cover_data,
+        start_time=start_time,
+        duration=duration,
+        profile=profile,
+        on_progress=on_progress,
+        output_path=output_path
+    )
+    if not video:
+        stage_failures.inc("render")
+    return video, profile, "full"
+
+class RenderError(RuntimeError):
+    """Ошибка задачи, текст которой показывается пользователю"""
+
+# Готовим видеокружок по данным задачи и отправляем его в чат
+@timed("job")
+async def deliver_video_note(
+    bot: Bot,
+    chat_id: int,
+    data: dict,
+    status: Callable[[str], Awaitable[None]] | None = None,
+    on_sent: Callable[[], Awaitable[None]] | None = None
+):
+    """
+    data — поля задачи из FSM (audio_path, cover_path, start_time, cut_sec, source_id, track_info).
+    status получает тексты для сообщения о ходе генерации, on_sent вызывается сразу после отправки.
+    """
+    audio_path = data.get("audio_path")
+    cover_path = data.get("cover_path") or DEFAULT_COVER
+    start_time = data.get("start_time", 0)
+    track_info = data.get("track_info", "Ваш трек")
+    
+    if not audio_path or not os.path.exists(audio_path):
+        logging.error("Аудиофайл не найден")
+        raise RenderError("Ошибка: аудиофайл не найден")
+    # Пока идет рендер, очистка временных файлов не трогает каталог задачи
+    await run_io(mark_in_progress, data.get("workspace"))
+    
+    # Тот же исходник с той же обрезкой и обложкой уже рендерили.
+    # В кэше только рендеры профиля по умолчанию: упрощенный под нагрузкой результат не сохраняется
+    cache_key = None
+    source_id = data.get("source_id")
+    if source_id and os.path.exists(cover_path):
+        cache_key = await run_io(
+            result_cache.make_cache_key, source_id, data.get("cut_sec", 0), cover_path,
+            f"{RENDER_PARAMS}|{default_profile.describe()}"
+        )
+        if await send_cached_result(bot, chat_id, cache_key):
+            if on_sent:
+                await on_sent()
+            await cleanup_temp_files(audio_path, cover_path)
             return
-        
-        logging.info(f"Генерация видеокружка для: audio={audio_path}, cover={cover_path}")
 
-        # Определяем длительность трека
+    logging.info(f"Генерация видеокружка для: audio={audio_path}, cover={cover_path}")
+
+    # Определяем длительность фрагмента (с учетом точки обрезки)
+    try:
+        info = await probe(source_id, audio_path)
+    except Exception as e:
+        logging.error(f"Ошибка разбора аудиофайла {audio_path}: {e}")
+        raise RenderError("Не удалось прочитать аудиофайл. Попробуйте другой трек.")
+    duration = min(60, info.duration - start_time)
+
+    if duration <= 0:
+        raise RenderError("Точка обрезки находится за концом трека. Выберите другую.")
+
+    # Преобразуем обложку в квадрат
+    if cover_path and cover_path != DEFAULT_COVER and os.path.exists(cover_path):
+        square_cover = await convert_to_square(cover_path)
+    else:
+        square_cover = DEFAULT_COVER
+
+    # Показываем позицию в очереди рендера
+    queued = False
+
+    async def on_position(position: int, eta: int):
+        nonlocal queued
+        queued = True
+        if status:
+            await status(
+                f"⏳ Генерирую видеокружок для:\n{track_info}\n\n"
+                f"🕒 Вы в очереди: {position}, ожидание ~{eta} сек."
+            )
+
+    # Ход кодирования из прогресса ffmpeg: не чаще раза в STATUS_UPDATE_INTERVAL секунд
+    last_update = 0.0
+    status_task: asyncio.Task | None = None
+
+    async def report_progress(text: str):
         try:
-            audio = MP3(audio_path)
-            duration = min(60, audio.info.length)
+            await status(text)
         except Exception as e:
-            logging.error(f"Ошибка получения длительности: {e}")
-            duration = 60
+            logging.debug(f"Не удалось обновить ход генерации: {e}")
+
+    def on_progress(done: float, speed: float):
+        nonlocal last_update, status_task
+        now = time.monotonic()
+        if not status or now - last_update < STATUS_UPDATE_INTERVAL or duration <= 0:
+            return
+        if status_task is not None and not status_task.done():
+            return
+        last_update = now
+        percent = min(99, int(done / duration * 100))
+        text = f"⏳ Генерирую видеокружок для:\n{track_info}\n\n🎬 Готово {percent}%"
+        if speed > 0:
+            text += f", осталось ~{math.ceil(max(0.0, duration - done) / speed)} сек."
+        status_task = asyncio.create_task(report_progress(text))
+
+    # Память под ffmpeg и готовое видео (в памяти — вывод ffmpeg и его копия в буфере отправки).
+    # Сборка из готового цикла только копирует видеодорожку — ей хватает FFMPEG_MUX_BYTES
+    output_reservation = 0 if UPLOAD_FROM_FILE else int(2 * duration * VIDEO_BYTES_PER_SECOND)
+    output_path = f"{os.path.splitext(audio_path)[0]}_note.mp4" if UPLOAD_FROM_FILE else None
+
+    wait_started = time.monotonic()
 
-        # Преобразуем обложку в квадрат
-        if cover_path and cover_path != DEFAULT_COVER and os.path.exists(cover_path):
-            square_cover = await convert_to_square(cover_path)
+    async def slot_granted():
+        nonlocal queued
+        if wait_started:
+            stage_duration.observe("render_wait", time.monotonic() - wait_started)
+        if queued and status:
+            queued = False
+            await status(f"⏳ Генерирую видеокружок для:\n{track_info}\n\nЭто займет 20-60 секунд...")
+
+    def stop_progress():
+        # Запоздалая правка хода генерации не должна прийти после итогового статуса
+        if status_task is not None and not status_task.done():
+            status_task.cancel()
+
+    # Резерв памяти выбирается и занимается до слота планировщика: в слоте задача бюджета не ждет
+    video = None
+    profile, mode = default_profile, "loop"
+    encode_seconds = 0.0
+    waiting = 0
+    acquired = 0
+    try:
+        loop_failed = False
+        if COVER_LOOP_ENABLED and await run_io(cached_cover_loop, square_cover):
+            acquired = await memory_budget.acquire(FFMPEG_MUX_BYTES + output_reservation)
+            async with render_scheduler.slot(chat_id, on_position):
+                await slot_granted()
+                waiting = render_scheduler.waiting
+                # Цикл могли вытеснить, пока задача ждала: собирать его под малым резервом нельзя
+                loop_path = await run_io(cached_cover_loop, square_cover)
+                if loop_path:
+                    started = time.monotonic()
+                    try:
+                        video = await make_video_from_loop_bytes(
+                            loop_path=loop_path,
+                            audio_path=audio_path,
+                            start_time=start_time,
+                            duration=duration,
+                            on_progress=on_progress,
+                            output_path=output_path
+                        )
+                    finally:
+                        stop_progress()
+                    encode_seconds = time.monotonic() - started
+                    loop_failed = not video
+            if not video:
+                # Полный рендер встает в очередь заново — уже с резервом под libx264
+                logging.warning("Сборка из цикла не удалась, задача ждет полного рендера")
+                memory_budget.release(acquired)
+                acquired = 0
+                wait_started = 0.0
+
+        if not video:
+            acquired = await memory_budget.acquire(FFMPEG_PROCESS_BYTES + output_reservation)
+            async with render_scheduler.slot(chat_id, on_position):
+                await slot_granted()
+                # Профиль полного рендера зависит от очереди и скорости последних кодирований
+                waiting = render_scheduler.waiting
+                profile = encoding_controller.choose(waiting, render_scheduler.max_concurrency)
+                started = time.monotonic()
+                try:
+                    video, profile, mode = await render_video_note(
+                        audio_path, square_cover, start_time, duration, profile, on_progress, output_path,
+                        use_loop=COVER_LOOP_ENABLED and not loop_failed
+                    )
+                finally:
+                    stop_progress()
+                encode_seconds = time.monotonic() - started
+
+        if video:
+            encoding_controller.record(encode_seconds, mode)
+
+        if isinstance(video, str):
+            output_bytes = await run_io(os.path.getsize, video)
         else:
-            square_cover = DEFAULT_COVER
-
-        # Генерируем видеокружок
-        video_bytes = await make_rotating_circle_video_bytes(
-            audio_path=audio_path,
-            cover_path=square_cover,
-            start_time=start_time,
-            duration=duration
+            output_bytes = len(video) if video else 0
+        await save_render_stats(
+            chat_id, profile.name, mode, cache_key, duration, encode_seconds, output_bytes, waiting
         )
-        
-        # Отправляем результат
-        if video_bytes:
-            video_file = BufferedInputFile(video_bytes, filename="video_note.mp4")
-            await message.answer_video_note(video_file)
-        else:
+
+        if not video:
             raise RuntimeError("Ошибка генерации видеокружка")
-        
-        # Очищаем временные файлы
-        await cleanup_temp_files(audio_path, square_cover)
+
+        # Отправляем результат (память под видео держим до конца отправки)
+        if isinstance(video, str):
+            video_file = FSInputFile(video, filename="video_note.mp4")
+        else:
+            video_file = BufferedInputFile(video, filename="video_note.mp4")
+        # Во фрагментированном MP4 нет общей длительности — передаем ее явно
+        sent = await _send_video_file(bot, chat_id, video_file, duration=int(duration), length=profile.size)
+        if on_sent:
+            await on_sent()
+        if cache_key and profile is default_profile:
+            if sent.video_note:
+                await result_cache.remember_file_id(cache_key, sent.video_note.file_id)
+            if isinstance(video, str):
+                await run_io(result_cache.store_file, cache_key, video)
+            else:
+                await run_io(result_cache.store_bytes, cache_key, video)
+    finally:
+        memory_budget.release(acquired)
+        if output_path and os.path.exists(output_path):
+            await remove_temp_file(output_path)
+    
+    # Очищаем временные файлы
+    await cleanup_temp_files(audio_path, square_cover)
+
+# Отправляем результат пользователю
+async def send_result(message: Message, state, status_msg: Message | None = None):
+    try:
+        data = await state.get_data()
+
+        async def status(text: str):
+            if status_msg:
+                try:
+                    await status_msg.edit_text(text)
+                except TelegramBadRequest:
+                    pass
+
+        await deliver_video_note(message.bot, message.chat.id, data, status)
+    except RenderError as e:
+        await message.answer(f"❌ {e}")
     except Exception as e:
         logging.exception("Критическая ошибка в send_result:")
         await message.answer("❌ Произошла непредвиденная ошибка. Пожалуйста, попробуйте ещё раз.")
 
+# Завершаем задачу пользователя: удаляем ее рабочий каталог и сбрасываем FSM
+async def finish_job(state, workspace: str | None = None):
+    """
+    Удаляет каталог задачи и сбрасывает состояние. workspace — каталог завершенного рендера:
+    если пользователь уже начал новую задачу, ее каталог и состояние не трогаем.
+    """
+    data = await state.get_data()
+    current = data.get("workspace")
+    await run_io(remove_workspace, workspace or current)
+    if workspace is None or workspace == current:
+        await state.clear()
+
 # Очищаем временные файлы
 async def cleanup_temp_files(audio_path: str, cover_path: str):
+    # Удаляются только ссылки каталога задачи, сами файлы кэша исходников остаются
+    source_cache.release(audio_path)
+    source_cache.release(cover_path)
     try:
         # Удаляем основной аудиофайл
         if audio_path and os.path.exists(audio_path):
@@ -299,15 +686,6 @@ async def cleanup_temp_files(audio_path: str, cover_path: str):
         if cover_path != DEFAULT_COVER and cover_path and os.path.exists(cover_path):
             await remove_temp_file(cover_path)
         
-        # Удаляем производные файлы
-        if audio_path:
-            base_name = os.path.basename(audio_path)
-            base_prefix = base_name.split('.')[0]
-            
-            for file in os.listdir(TEMP_DIR):
-                if file.startswith(base_prefix) and file != base_name:
-                    file_path = os.path.join(TEMP_DIR, file)
-                    if os.path.isfile(file_path) and not file.endswith(".mp4"):
-                        await remove_temp_file(file_path)
+        # Производные файлы лежат в каталоге задачи и удаляются вместе с ним
     except Exception as e:
         logging.error(f"Ошибка очистки временных файлов: {e}")
\ No newline at end of file
@@ -3,113 +3,371 @@ import logging
 import shutil
 import os
 import time
-from typing import Optional
-from config import TEMP_DIR
+from collections import deque
+from functools import lru_cache
+from typing import Callable, Optional
+from config import (
+    TEMP_DIR, FFMPEG_PIPE_OUTPUT, FFMPEG_STALL_TIMEOUT,
+    FFMPEG_DEADLINE_BASE, FFMPEG_DEADLINE_FACTOR, FFMPEG_DEFAULT_DEADLINE
+)
+from offload import run_io
+from metrics import timed, gauge
+from encoding import EncodingProfile, default_profile
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Параметры рендера, влияющие на результат (входят в ключ кэша готовых видео)
+RENDER_PARAMS = "512x512|fit=crop|rotate=0.5*t|libx264:baseline:4.2|aac:128k|fade=3"
+
+def video_filter(size: int) -> str:
+    # Обложка заполняет кадр и обрезается по центру, как в imaging.make_square:
+    # цикл и полный рендер дают одинаковую картинку и из исходной, и из квадратной обложки
+    return (
+        f"scale={size}:{size}:force_original_aspect_ratio=increase,crop={size}:{size},"
+        f"rotate='angle=0.5*t:ow={size}:oh={size}',format=yuv420p"
+    )
+
+def piped_cover_filter(fps: int) -> str:
+    # Обложка из stdin приходит одним кадром: размножаем его и заново нумеруем время
+    return f"loop=loop=-1:size=1:start=0,setpts=N/{fps}/TB,"
+
+# Фрагментированный MP4 пишется в stdout без перемотки к началу файла
+PIPE_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+# Ключи блоков -progress; остальные строки stderr — сообщения об ошибках
+PROGRESS_KEYS = {
+    "frame", "fps", "stream_0_0_q", "bitrate", "total_size", "out_time_us", "out_time_ms",
+    "out_time", "dup_frames", "drop_frames", "speed", "progress"
+}
+
+@lru_cache(maxsize=1)
 def check_ffmpeg_installed() -> bool:
-    """Проверяет наличие ffmpeg в системе."""
+    """Проверяет наличие ffmpeg в системе (один раз за время работы процесса)."""
     return shutil.which("ffmpeg") is not None
 
 def build_ffmpeg_cmd(*args: str) -> list[str]:
     return ["ffmpeg", "-hide_banner", "-loglevel", "error"] + list(args)
 
-async def run_ffmpeg(cmd: list[str]) -> tuple[bool, Optional[bytes]]:
+# Колбэк прогресса ffmpeg: (готово секунд результата, скорость относительно реального времени)
+ProgressCallback = Callable[[float, float], None]
+
+# Причины принудительной остановки ffmpeg -> число остановок
+_kills: dict[str, int] = {}
+gauge("winyl_ffmpeg_killed_total", "Остановленные процессы ffmpeg", lambda: dict(_kills), label="reason", kind="counter")
+
+def _deadline(duration: Optional[float]) -> float:
+    """Предельное время работы ffmpeg для результата длительностью duration"""
+    if duration is None:
+        return FFMPEG_DEFAULT_DEADLINE
+    return FFMPEG_DEADLINE_BASE + FFMPEG_DEADLINE_FACTOR * duration
+
+async def run_ffmpeg(
+    cmd: list[str],
+    input_data: Optional[bytes] = None,
+    capture_output: bool = False,
+    duration: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None
+) -> tuple[bool, Optional[bytes]]:
+    """
+    Запускает ffmpeg. input_data подается в stdin (pipe:0),
+    при capture_output возвращает содержимое stdout (pipe:1).
+    Прогресс читается из stderr (-progress pipe:2): процесс останавливается, если результат
+    не растет FFMPEG_STALL_TIMEOUT секунд или работа длится дольше срока по duration.
+    """
+    # -progress пишет блоки key=value, -nostats убирает обычную строку статистики
+    cmd = [cmd[0], "-progress", "pipe:2", "-nostats", *cmd[1:]]
     logger.info(f"Команда ffmpeg: {' '.join(cmd)}")
     
     proc = await asyncio.create_subprocess_exec(
         *cmd,
-        stdout=asyncio.subprocess.PIPE,
+        stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE if capture_output else asyncio.subprocess.DEVNULL,
         stderr=asyncio.subprocess.PIPE
     )
+
+    started = time.monotonic()
+    last_advance = started
+    out_time = 0.0
+    speed = 0.0
+    killed = None
+
+    async def feed_stdin():
+        if input_data is None:
+            return
+        try:
+            proc.stdin.write(input_data)
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg завершился раньше, чем прочитал вход — причина будет в stderr
+            logger.warning("ffmpeg закрыл stdin до конца записи")
+        finally:
+            proc.stdin.close()
+
+    async def read_stdout():
+        return await proc.stdout.read() if capture_output else None
+
+    async def read_stderr() -> list[str]:
+        nonlocal last_advance, out_time, speed
+        errors = deque(maxlen=50)
+        async for raw in proc.stderr:
+            line = raw.decode(errors="replace").strip()
+            key, sep, value = line.partition("=")
+            if not sep or key not in PROGRESS_KEYS:
+                if line:
+                    errors.append(line)
+            elif key == "out_time_us" and value.isdigit():
+                if int(value) / 1_000_000 > out_time:
+                    out_time = int(value) / 1_000_000
+                    last_advance = time.monotonic()
+            elif key == "speed" and value.endswith("x"):
+                try:
+                    speed = float(value[:-1])
+                except ValueError:
+                    pass
+            elif key == "progress" and on_progress:
+                try:
+                    on_progress(out_time, speed)
+                except Exception as e:
+                    logger.warning(f"Ошибка обработки прогресса ffmpeg: {e}")
+        return list(errors)
+
+    async def watchdog():
+        nonlocal killed
+        deadline = started + _deadline(duration)
+        while proc.returncode is None:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            if now > deadline:
+                killed = "deadline"
+            elif now - last_advance > FFMPEG_STALL_TIMEOUT:
+                killed = "stall"
+            else:
+                continue
+            logger.error(
+                f"ffmpeg остановлен ({killed}): {now - started:.0f} сек работы, "
+                f"готово {out_time:.1f} сек результата"
+            )
+            _kills[killed] = _kills.get(killed, 0) + 1
+            proc.kill()
+            return
+
+    guard = asyncio.create_task(watchdog())
+    try:
+        # Пишем stdin и читаем оба канала одновременно, чтобы ffmpeg не встал на полном буфере
+        _, output, errors = await asyncio.gather(
+            feed_stdin(),
+            read_stdout(),
+            read_stderr()
+        )
+        
+        # Дожидаемся завершения процесса
+        return_code = await proc.wait()
+    finally:
+        guard.cancel()
+        if proc.returncode is None:
+            # Задачу отменили — не оставляем ffmpeg работать без хозяина
+            proc.kill()
+            await proc.wait()
     
-    # Читаем stderr в реальном времени
-    stderr_chunks = []
-    while True:
-        chunk = await proc.stderr.read(4096)
-        if not chunk:
-            break
-        stderr_chunks.append(chunk)
-    
-    # Дожидаемся завершения процесса
-    return_code = await proc.wait()
-    
-    if return_code == 0:
-        logger.info("ffmpeg успешно завершил работу.")
-        return True, None
+    if return_code == 0 and killed is None:
+        logger.info(f"ffmpeg успешно завершил работу за {time.monotonic() - started:.1f} сек.")
+        return True, output
     else:
-        error_msg = b''.join(stderr_chunks).decode().strip()
-        logger.error(f"ffmpeg ошибка: {error_msg}")
+        error_msg = "\n".join(errors)
+        logger.error(f"ffmpeg ошибка: {error_msg or f'код {return_code}'}")
         return False, None
 
+def _cover_input_args(cover_path: str, cover_data: Optional[bytes], fps: int) -> tuple[list[str], str]:
+    """Аргументы входа обложки и префикс фильтра (файл или bytes через stdin)"""
+    if cover_data is not None:
+        return ["-f", "image2pipe", "-framerate", str(fps), "-i", "pipe:0"], piped_cover_filter(fps)
+    return ["-loop", "1", "-framerate", str(fps), "-i", cover_path], ""
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+async def render_to_bytes(
+    args: list[str],
+    input_data: Optional[bytes] = None,
+    duration: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None
+) -> Optional[bytes]:
+    """Запускает ffmpeg и возвращает готовый MP4: из stdout или через временный файл"""
+    if FFMPEG_PIPE_OUTPUT:
+        cmd = build_ffmpeg_cmd(*args, "-movflags", PIPE_MOVFLAGS, "-f", "mp4", "pipe:1")
+        success, video_bytes = await run_ffmpeg(
+            cmd, input_data, capture_output=True, duration=duration, on_progress=on_progress
+        )
+        return video_bytes if success and video_bytes else None
+
+    # Создаем уникальное имя для временного файла
+    output_path = os.path.join(TEMP_DIR, f"video_{int(time.time() * 1000)}.mp4")
+    cmd = build_ffmpeg_cmd("-y", *args, "-movflags", "+faststart", output_path)
+    
+    success, _ = await run_ffmpeg(cmd, input_data, duration=duration, on_progress=on_progress)
+    
+    try:
+        if not success:
+            return None
+        return await run_io(_read_file, output_path)
+    except Exception as e:
+        logger.error(f"Ошибка чтения видеофайла: {e}")
+        return None
+    finally:
+        # Всегда удаляем временный файл
+        if os.path.exists(output_path):
+            try:
+                os.remove(output_path)
+                logger.info(f"Временный файл видео удалён: {output_path}")
+            except Exception as e:
+                logger.error(f"Ошибка удаления временного файла: {e}")
+
+async def render_to_file(
+    args: list[str],
+    output_path: str,
+    input_data: Optional[bytes] = None,
+    duration: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None
+) -> bool:
+    """Запускает ffmpeg с записью MP4 в output_path (видео не проходит через память бота)"""
+    cmd = build_ffmpeg_cmd("-y", *args, "-movflags", "+faststart", output_path)
+    success, _ = await run_ffmpeg(cmd, input_data, duration=duration, on_progress=on_progress)
+    return success
+
+async def _render(
+    args: list[str],
+    output_path: Optional[str],
+    input_data: Optional[bytes] = None,
+    duration: Optional[float] = None,
+    on_progress: Optional[ProgressCallback] = None
+) -> bytes | str | None:
+    if output_path:
+        return output_path if await render_to_file(args, output_path, input_data, duration, on_progress) else None
+    return await render_to_bytes(args, input_data, duration, on_progress)
+
+@timed("render_full", empty_is_failure=True)
 async def make_rotating_circle_video_bytes(
     audio_path: str,
     cover_path: str,
     start_time: int = 0,
-    duration: int = 60
-) -> Optional[bytes]:
-    """Генерирует видео в формате видеокружка и возвращает bytes"""
+    duration: int = 60,
+    cover_data: Optional[bytes] = None,
+    profile: EncodingProfile = default_profile,
+    on_progress: Optional[ProgressCallback] = None,
+    output_path: Optional[str] = None
+) -> bytes | str | None:
+    """Генерирует видео в формате видеокружка и возвращает bytes (при output_path — путь к файлу)"""
     if not check_ffmpeg_installed():
         logger.error("ffmpeg не установлен в системе.")
         return None
 
-    # Создаем уникальное имя для временного файла
-    output_path = os.path.join(TEMP_DIR, f"video_{int(time.time() * 1000)}.mp4")
-    
     # Рассчитываем параметры затухания аудио
     fade_in_duration = min(3, duration)  # Не более длительности самого аудио
     fade_out_start = max(0, duration - 3)  # Начинаем затухание за 3 секунды до конца
     
-    # Формируем команду ffmpeg (рабочая версия)
-    cmd = build_ffmpeg_cmd(
-        "-y",
+    cover_args, filter_prefix = _cover_input_args(cover_path, cover_data, profile.fps)
+
+    # Формируем аргументы ffmpeg (рабочая версия)
+    args = [
         "-ss", str(start_time),
         "-t", str(duration),
         "-i", audio_path,
-        "-loop", "1", 
-        "-i", cover_path,
-        "-c:v", "libx264",
-        "-vf", "scale=512:512:force_original_aspect_ratio=1,pad=512:512:(ow-iw)/2:(oh-ih)/2,rotate='angle=0.5*t:ow=512:oh=512',format=yuv420p",
+        *cover_args,
+        *profile.video_args(),
+        "-vf", filter_prefix + video_filter(profile.size),
         "-af", f"afade=t=in:st=0:d={fade_in_duration},afade=t=out:st={fade_out_start}:d=3",
         "-c:a", "aac", "-b:a", "128k",
         "-pix_fmt", "yuv420p",
         "-profile:v", "baseline",
         "-level", "4.2",
-        "-movflags", "+faststart",
         "-map", "0:a:0",
         "-map", "1:v:0",
+        "-t", str(duration),
         "-shortest",
-        output_path
-    )
+    ]
     
-    logger.info(f"Генерация видео: аудио={audio_path}, обложка={cover_path}, длительность={duration} сек")
-    
-    success, _ = await run_ffmpeg(cmd)
+    logger.info(
+        f"Генерация видео: аудио={audio_path}, обложка={cover_path}, длительность={duration} сек, "
+        f"профиль={profile.name}"
+    )
     
-    if success:
-        try:
-            with open(output_path, "rb") as f:
-                video_bytes = f.read()
-            logger.info("Видео успешно сгенерировано")
-            return video_bytes
-        except Exception as e:
-            logger.error(f"Ошибка чтения видеофайла: {e}")
-            return None
-        finally:
-            # Всегда удаляем временный файл
-            try:
-                os.remove(output_path)
-                logger.info(f"Временный файл видео удалён: {output_path}")
-            except Exception as e:
-                logger.error(f"Ошибка удаления временного файла: {e}")
-    else:
-        # Удаляем файл в случае ошибки
-        if os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-                logger.info(f"Временный файл видео удалён после ошибки: {output_path}")
-            except Exception as e:
-                logger.error(f"Ошибка удаления временного файла: {e}")
-        return None
\ No newline at end of file
+    video_bytes = await _render(args, output_path, cover_data, duration, on_progress)
+    if video_bytes:
+        logger.info("Видео успешно сгенерировано")
+    return video_bytes
+
+@timed("render_cover_loop", empty_is_failure=True)
+async def render_cover_loop(
+    cover_path: str,
+    output_path: str,
+    cover_data: Optional[bytes] = None,
+    profile: EncodingProfile = default_profile
+) -> bool:
+    """Рендерит один полный оборот обложки (только видео) для последующего копирования"""
+    if not check_ffmpeg_installed():
+        logger.error("ffmpeg не установлен в системе.")
+        return False
+
+    cover_args, filter_prefix = _cover_input_args(cover_path, cover_data, profile.fps)
+
+    cmd = build_ffmpeg_cmd(
+        "-y",
+        *cover_args,
+        "-frames:v", str(profile.rotation_period_frames),
+        "-vf", filter_prefix + video_filter(profile.size),
+        *profile.video_args(),
+        "-pix_fmt", "yuv420p",
+        "-profile:v", "baseline",
+        "-level", "4.2",
+        "-an",
+        "-movflags", "+faststart",
+        output_path
+    )
+
+    logger.info(f"Рендер цикла вращения: обложка={cover_path}, профиль={profile.name}")
+    success, _ = await run_ffmpeg(cmd, cover_data, duration=profile.rotation_period_frames / profile.fps)
+    return success
+
+@timed("render_from_loop", empty_is_failure=True)
+async def make_video_from_loop_bytes(
+    loop_path: str,
+    audio_path: str,
+    start_time: int = 0,
+    duration: int = 60,
+    on_progress: Optional[ProgressCallback] = None,
+    output_path: Optional[str] = None
+) -> bytes | str | None:
+    """
+    Собирает видеокружок из готового цикла вращения (-c:v copy) и аудио с затуханием.
+    Возвращает bytes, при output_path — путь к файлу.
+    """
+    if not check_ffmpeg_installed():
+        logger.error("ffmpeg не установлен в системе.")
+        return None
+
+    fade_in_duration = min(3, duration)
+    fade_out_start = max(0, duration - 3)
+
+    args = [
+        "-stream_loop", "-1",
+        "-i", loop_path,
+        "-ss", str(start_time),
+        "-t", str(duration),
+        "-i", audio_path,
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+        "-c:v", "copy",
+        "-af", f"afade=t=in:st=0:d={fade_in_duration},afade=t=out:st={fade_out_start}:d=3",
+        "-c:a", "aac", "-b:a", "128k",
+        "-t", str(duration),
+        "-shortest",
+    ]
+
+    logger.info(f"Сборка видео из цикла: аудио={audio_path}, цикл={loop_path}, длительность={duration} сек")
+
+    video_bytes = await _render(args, output_path, duration=duration, on_progress=on_progress)
+    if video_bytes:
+        logger.info("Видео собрано из цикла вращения")
+    return video_bytes
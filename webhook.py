@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import socket
+import sys
+import time
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_WORKERS, WEBHOOK_STOP_TIMEOUT, RENDER_MODE, RENDER_MAX_CONCURRENCY, MEMORY_BUDGET_BYTES, METRICS_HOST, METRICS_PORT, READY_FILE
+)
+from db import init_db, close_db
+from job_queue import render_queue
+from offload import shutdown_offload
+from metrics import start_metrics_server
+from startup import warm_up, mark_ready, clear_ready
+from scheduler import render_scheduler
+from budget import memory_budget
+from utils import ensure_temp_dir
+from Winyl import setup_logging, create_bot, create_dispatcher, start_background_tasks, stop_background_tasks
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+async def _set_webhook():
+    """Регистрирует вебхук один раз из родительского процесса"""
+    bot = create_bot()
+    try:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=100
+        )
+        logger.info(f"Вебхук установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    finally:
+        await bot.session.close()
+
+
+async def _serve(index: int, workers: int):
+    """Процесс-обработчик: свой event loop, свой бюджет рендера, общий порт"""
+    ensure_temp_dir()
+
+    # Ядра и бюджет памяти машины делятся между процессами поровну
+    render_scheduler.max_concurrency = max(1, RENDER_MAX_CONCURRENCY // workers)
+    memory_budget.limit = MEMORY_BUDGET_BYTES // workers
+
+    # У каждого процесса свои счетчики — и свой порт метрик (/ready — готовность процесса)
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT + index) if METRICS_PORT else None
+
+    await init_db()
+    bot = create_bot()
+    dp = create_dispatcher(multiprocess=workers > 1)
+    problems = await warm_up(primary=index == 0)
+    tasks = start_background_tasks(bot, primary=index == 0)
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=workers > 1)
+    await site.start()
+    logger.info(
+        f"Обработчик {index} слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} "
+        f"(рендеров одновременно: {render_scheduler.max_concurrency}, "
+        f"память: {memory_budget.limit // (1024 * 1024)} МБ)"
+    )
+    # Общий файл готовности ведет первый процесс
+    ready_file = READY_FILE if index == 0 else None
+    mark_ready(problems, ready_file)
+
+    # SIGTERM (остановка родителем или systemd) и SIGINT завершают работу штатно, через finally
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            # Windows: остается KeyboardInterrupt от asyncio.run
+            pass
+
+    try:
+        await stop.wait()
+        logger.info(f"Обработчик {index} получил сигнал завершения")
+    finally:
+        clear_ready(ready_file)
+        await stop_background_tasks(tasks)
+        await runner.cleanup()
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await render_queue.close()
+        await close_db()
+        shutdown_offload()
+
+
+def _worker(index: int, workers: int):
+    setup_logging()
+    try:
+        asyncio.run(_serve(index, workers))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_webhook():
+    """Запускает WEBHOOK_WORKERS процессов за одним портом и перезапускает упавшие"""
+    setup_logging()
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL не задан для режима webhook")
+
+    workers = max(1, WEBHOOK_WORKERS)
+    # Каждый процесс рендерит хотя бы один видеокружок: больше процессов, чем слотов, перегрузит ядра
+    if RENDER_MODE != "queue" and workers > RENDER_MAX_CONCURRENCY:
+        logger.warning(
+            f"WEBHOOK_WORKERS={workers} больше RENDER_MAX_CONCURRENCY={RENDER_MAX_CONCURRENCY}: "
+            f"запускается процессов: {max(1, RENDER_MAX_CONCURRENCY)}"
+        )
+        workers = max(1, RENDER_MAX_CONCURRENCY)
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning("SO_REUSEPORT не поддерживается системой, запускается один процесс")
+        workers = 1
+
+    asyncio.run(_set_webhook())
+
+    if workers == 1:
+        _worker(0, 1)
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+
+    def spawn(index: int):
+        process = ctx.Process(target=_worker, args=(index, workers), name=f"winyl-worker-{index}")
+        process.start()
+        return process
+
+    # Без обработчика SIGTERM родитель завершился бы, не остановив обработчики
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    processes = [spawn(i) for i in range(workers)]
+    logger.info(f"Запущено процессов-обработчиков: {workers}")
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапуск")
+                    processes[index] = spawn(index)
+    finally:
+        # SIGTERM: обработчики удаляют файл готовности и закрывают БД в своих finally
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + WEBHOOK_STOP_TIMEOUT
+        for index, process in enumerate(processes):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"Обработчик {index} не завершился за {WEBHOOK_STOP_TIMEOUT} сек, принудительная остановка")
+                process.kill()
+                process.join()
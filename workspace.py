@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+from config import TEMP_DIR, WORK_DIR, TEMP_QUOTA_BYTES, TEMP_MAX_AGE, JANITOR_INTERVAL
+from metrics import gauge
+from offload import run_io
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Префикс каталогов задач
+WORKSPACE_PREFIX = "job_"
+
+# Отметка в каталоге задачи, которая ждет рендера или рендерится: очистка такой каталог не трогает
+IN_PROGRESS_MARKER = ".in_progress"
+
+
+def create_workspace() -> str:
+    """Создает изолированный каталог задачи (в WORK_DIR, например на tmpfs)"""
+    os.makedirs(WORK_DIR, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=WORKSPACE_PREFIX, dir=WORK_DIR)
+    logger.info(f"Создан рабочий каталог задачи: {path}")
+    return path
+
+
+def is_workspace(path: str) -> bool:
+    """Каталог задачи в WORK_DIR (а не произвольный путь)"""
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(WORK_DIR) \
+        and os.path.basename(path).startswith(WORKSPACE_PREFIX)
+
+
+def remove_workspace(path: str | None):
+    """Удаляет каталог задачи со всем содержимым"""
+    if not path:
+        return
+    # Удаляем только собственные каталоги задач
+    if not is_workspace(path):
+        logger.warning(f"Отказ удалять каталог вне рабочей директории: {path}")
+        return
+    shutil.rmtree(path, ignore_errors=True)
+    logger.info(f"Рабочий каталог задачи удалён: {path}")
+
+
+def discard_workspace(path: str | None):
+    """Удаляет прежний каталог задачи, если его не занял рендер (тогда его удалит владелец)"""
+    if path and _in_progress(path, time.time()):
+        logger.info(f"Каталог задачи в работе, оставляю его владельцу: {path}")
+        return
+    remove_workspace(path)
+
+
+def mark_in_progress(path: str | None):
+    """Отмечает каталог задачи как занятый рендером (отметка видна всем процессам)"""
+    if not path:
+        return
+    marker = os.path.join(path, IN_PROGRESS_MARKER)
+    try:
+        with open(marker, "a"):
+            pass
+        os.utime(marker)
+    except OSError as e:
+        logger.warning(f"Не удалось отметить каталог задачи {path}: {e}")
+
+
+def _in_progress(path: str, now: float) -> bool:
+    # Отметка упавшего процесса устаревает через TEMP_MAX_AGE и больше не защищает каталог
+    try:
+        return now - os.stat(os.path.join(path, IN_PROGRESS_MARKER)).st_mtime < TEMP_MAX_AGE
+    except OSError:
+        return False
+
+
+def link_file(source: str, destination: str):
+    """Ставит на source жесткую ссылку destination (на другой файловой системе — символическую)"""
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+        logger.info(f"Файл связан жесткой ссылкой: {source} -> {destination}")
+    except OSError as e:
+        # Другая файловая система или нет прав — ссылаемся на файл напрямую
+        logger.info(f"Жесткая ссылка невозможна ({e}), использую символическую")
+        os.symlink(os.path.abspath(source), destination)
+
+
+def _entry_size(path: str) -> int:
+    if os.path.isdir(path) and not os.path.islink(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return total
+    return os.lstat(path).st_size
+
+
+def _remove_entry(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+
+
+# Объем временных файлов по последнему проходу очистки (None — очистка еще не проходила)
+_last_usage: int | None = None
+
+# Метрика отдает объем, посчитанный очисткой, а не обходит каталоги при каждом опросе
+gauge("winyl_temp_bytes", "Размер временных файлов и каталогов задач (по последней очистке)",
+      lambda: {} if _last_usage is None else _last_usage)
+
+
+def sweep() -> int:
+    """
+    Удаляет из TEMP_DIR и WORK_DIR записи старше TEMP_MAX_AGE,
+    затем самые старые записи сверх TEMP_QUOTA_BYTES. Каталоги задач в работе
+    (с отметкой IN_PROGRESS_MARKER) учитываются в объеме, но не удаляются.
+    Возвращает число освобожденных байт.
+    """
+    entries = []
+    now = time.time()
+    directories = {os.path.abspath(TEMP_DIR), os.path.abspath(WORK_DIR)}
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            # WORK_DIR может лежать внутри TEMP_DIR — его самого не трогаем
+            if os.path.abspath(entry.path) in directories:
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                busy = entry.is_dir(follow_symlinks=False) and _in_progress(entry.path, now)
+                entries.append((stat.st_mtime, _entry_size(entry.path), entry.path, busy))
+            except OSError:
+                continue
+
+    entries.sort()
+    total = sum(size for _, size, _, _ in entries)
+    reclaimed = 0
+    removed = 0
+
+    for mtime, size, path, busy in entries:
+        if now - mtime < TEMP_MAX_AGE and total <= TEMP_QUOTA_BYTES:
+            break
+        if busy:
+            continue
+        try:
+            _remove_entry(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
+            continue
+        total -= size
+        reclaimed += size
+        removed += 1
+
+    global _last_usage
+    _last_usage = total
+
+    if removed:
+        logger.info(
+            f"Очистка временных файлов: удалено {removed}, освобождено {reclaimed / (1024 * 1024):.1f} МБ, "
+            f"занято {total / (1024 * 1024):.1f} МБ"
+        )
+    return reclaimed
+
+
+async def run_janitor():
+    """Периодически чистит временные каталоги"""
+    while True:
+        try:
+            await run_io(sweep)
+        except Exception as e:
+            logger.error(f"Ошибка очистки временных файлов: {e}")
+        await asyncio.sleep(JANITOR_INTERVAL)